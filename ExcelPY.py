@@ -1,13 +1,858 @@
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
 from datetime import datetime, date, time, timedelta
-from dateutil.parser import parse
-from openpyxl import load_workbook, Workbook
+from hashlib import blake2b, sha256
+from itertools import chain, islice
+from openpyxl import load_workbook, Workbook, __version__ as openpyxl_version
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.read_only import ReadOnlyCell
 from openpyxl.utils import get_column_letter
+from openpyxl.utils.indexed_list import IndexedList
 from openpyxl.styles import PatternFill, Font
-from os import system, name
-from colorama import init, Fore
-from random import randint
+from openpyxl.formatting.rule import FormulaRule
+from openpyxl.packaging.relationship import RelationshipList, get_dependents, get_rels_path
+from openpyxl.worksheet.cell_range import MultiCellRange
+from openpyxl.worksheet.dimensions import ColumnDimension, RowDimension
+from os import system, name, path, close, remove, replace, chmod, stat, makedirs, listdir, utime, environ
+from sys import platform
+from colorama import init, Fore, Style
+from random import Random
+from tempfile import mkstemp
+from time import sleep
 
 import argparse
+import csv
+import json
+import pickle
+import re
+import sqlite3
+import sys
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for --engine numpy
+    np = None
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed for parquet dump files
+    pq = None
+
+try:
+    from openpyxl.worksheet._reader import WorkSheetParser
+except ImportError:  # private to openpyxl and only needed for --write-only, see WRITE_ONLY_OPENPYXL
+    WorkSheetParser = None
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak memory is left out of the metrics there
+    resource = None
+
+# a single destination cell write produced by diffing a dump worksheet against its destination tab. kind is one of
+# 'update', 'reset' (value unchanged), 'append' (existing key, empty cell) or 'new' (key not in the destination, row numbers
+# the new keys from 1 in the order they were found)
+CellChange = namedtuple('CellChange', 'key header row col kind value old')
+
+
+def cell_change(key, header, value, old, dest_row, dest_col, new_rows):
+    """
+    Work out how one filled dump cell is synced, every diff engine hands its cells to this so they all produce the
+    same changeset.
+    :param key: primary key of the dump row
+    :param header: column header of the cell
+    :param value: the dump value, not None
+    :param old: the destination value, None when the destination cell is empty or the key is not there
+    :param dest_row: the key's row in the destination, None when the key is not there
+    :param dest_col: the header's column in the destination
+    :param new_rows: dictionary of key -> row offset past the current last row for keys not in the destination,
+                     numbered from 1 in the order they are found, updated in place
+    :return: CellChange
+    """
+    if dest_row is None:  # key is not present so we are creating a new row
+        return CellChange(key, header, new_rows.setdefault(key, len(new_rows) + 1), dest_col, 'new', value, old)
+    if old is None:  # we need to add the remaining values for columns
+        return CellChange(key, header, dest_row, dest_col, 'append', value, old)
+
+    return CellChange(key, header, dest_row, dest_col, 'update' if old != value else 'reset', value, old)
+
+# --write-only rebuilds the destination with openpyxl's private sheet parser and workbook attributes, so it is only
+# allowed on the openpyxl releases it was written against
+WRITE_ONLY_OPENPYXL = ('3.1.',)
+# the sheet parts a tab can have for --write-only: hyperlinks are copied and printer settings are dropped, as a normal
+# save does. Tabs with any other part (comments, drawings, tables, pivot tables...) are refused
+WRITE_ONLY_PARTS = {'hyperlink', 'printerSettings'}
+
+# cell formats are built once and shared, openpyxl stores each distinct style only once per workbook
+FILL_UPDATED = PatternFill(start_color='7fffd4', end_color='7fffd4', fill_type='solid')
+FONT_UPDATED = Font(name='Ubuntu', size=11, color='555555', bold=False, italic=False)
+FILL_RESET = PatternFill(fill_type='none')
+FONT_RESET = Font(name='Ubuntu', size=11, color='2e2e2e', bold=False, italic=False)
+# used by the conditional formatting rule that highlights past dates, see ExcelPY.format_date_columns
+FILL_DATE_PASSED = PatternFill(start_color='b22222', end_color='b22222', fill_type='solid')
+FONT_DATE_PASSED = Font(name='Ubuntu', size=11, color='ffffff', bold=False, italic=False)
+
+
+class LogSink:
+    # console and log file prefix, and console colour, of each level, lowest level first
+    levels = {'message': ('+++ ', Fore.GREEN), 'warning': ('--- ', Fore.YELLOW), 'error': ('!!! ', Fore.RED),
+              'summary': ('+++ ', Fore.GREEN)}
+
+    def __init__(self, level='message', fn=None, stream=None, colour=None, buffer_lines=200, repeat_limit=10):
+        """
+        Buffered output for ExcelPY's messages, warnings and errors. Lines are collected and written in blocks of
+        buffer_lines. Only lines at or above level are shown on the console, the log file gets every line. When more
+        than repeat_limit lines in a row share a group only the first ones are shown, followed by a count of the rest.
+        :param level: lowest level shown on the console, 'message', 'warning', 'error' or 'summary'
+        :param fn: optional file every line is appended to, without colour
+        :param stream: the console, sys.stdout when not given
+        :param colour: colour the console lines, by default only when the console is a terminal
+        :param buffer_lines: how many lines are collected before they are written
+        :param repeat_limit: how many lines of the same group are shown in a row
+        """
+        # looked up now rather than at import, colorama's init() replaces sys.stdout with its converting wrapper
+        self.stream = sys.stdout if stream is None else stream
+        self.colour = self.stream.isatty() if colour is None else colour
+        self.level = list(self.levels).index(level)
+        self.file = open(fn, 'a', encoding='utf-8') if fn is not None else None
+        self.buffer_lines = buffer_lines
+        self.repeat_limit = repeat_limit
+        self.lines = []  # console lines waiting to be written
+        self.file_lines = []  # log file lines waiting to be written
+        self.group = None  # (level, group) of the current run of lines
+        self.repeats = 0  # lines in the current run
+        self.suppressed = 0  # lines of the current run left off the console
+
+    def write(self, level, value, line_before=False, group=None):
+        """
+        Add a line to the log.
+        :param level: 'message', 'warning', 'error' or 'summary'
+        :param value: the line
+        :param line_before: boolean if a blank line should appear before the line
+        :param group: lines that are repeats of each other, the line itself when not given
+        :return: None
+        """
+        prefix, colour = self.levels[level]
+        group = (level, value if group is None else group)
+        if group != self.group:
+            self.end_run()
+            self.group = group
+        self.repeats += 1
+
+        if self.file is not None:
+            self.file_lines.append(('\n\n' if line_before else '') + prefix + value + '\n')
+            if len(self.file_lines) >= self.buffer_lines:
+                self.flush()
+
+        if list(self.levels).index(level) < self.level:  # left off the console
+            return
+        if self.repeats > self.repeat_limit:
+            self.suppressed += 1
+        elif self.colour:
+            self.lines.append(('\n\n' if line_before else '') + colour + prefix + value + Style.RESET_ALL + '\n')
+        else:
+            self.lines.append(('\n\n' if line_before else '') + prefix + value + '\n')
+
+        if len(self.lines) >= self.buffer_lines:
+            self.flush()
+
+    def end_run(self):
+        """
+        Finish the current run of lines, noting how many of them were left off the console.
+        :return: None
+        """
+        if self.suppressed > 0:
+            prefix, colour = self.levels[self.group[0]]
+            value = '... {} more like the above'.format(self.suppressed)
+            self.lines.append((colour + prefix + value + Style.RESET_ALL if self.colour else prefix + value) + '\n')
+
+        self.group = None
+        self.repeats = 0
+        self.suppressed = 0
+
+    def flush(self):
+        """
+        Write the collected lines.
+        :return: None
+        """
+        if len(self.lines) > 0:
+            self.stream.write(''.join(self.lines))
+            self.stream.flush()
+            self.lines = []
+        if len(self.file_lines) > 0:
+            self.file.write(''.join(self.file_lines))
+            self.file.flush()
+            self.file_lines = []
+
+    def close(self):
+        """
+        Write everything that is left and close the log file.
+        :return: None
+        """
+        self.end_run()
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ChangesetWriter:
+    # columns written for every change, key_type and new_type let apply mode restore non-string values
+    fields = ['tab', 'key', 'key_type', 'column', 'old', 'new', 'new_type', 'type']
+
+    def __init__(self, fn):
+        """
+        Stream changes found by ExcelPY.diff_dump_file to a JSONL or CSV file (chosen by extension) instead of
+        writing them to the destination workbook. Unchanged cells get a 'reset' record so apply mode can clear their
+        highlighting, each date column gets a 'date-column' record so it can install the past-date highlighting.
+        :param fn: the file to write to
+        """
+        self.fn = fn
+        self.tab = None  # destination tab of the changes currently being written
+        self.count = 0  # cells passed to append, kept so len() matches a list of changes
+        self.updated = 0
+        self.appended = 0
+        self.file = open(fn, 'w', newline='', encoding='utf-8')
+        self.csv = None
+        if fn.lower().endswith('.csv'):
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(self.fields)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, change):
+        """
+        Record one CellChange.
+        :param change: the change to record
+        :return: None
+        """
+        self.count += 1
+        if change.kind == 'update':
+            self.updated += 1
+            self.write(change, 'update')
+        elif change.kind in ('append', 'new'):
+            self.appended += 1
+            self.write(change, 'append')
+        else:
+            self.write(change, 'reset')
+
+    def write_date_columns(self, headers):
+        """
+        Record the date columns of the current tab.
+        :param headers: the date column headers
+        :return: None
+        """
+        for header in headers:
+            self.write(CellChange(None, header, None, None, 'date-column', None, None), 'date-column')
+
+    def write(self, change, change_type):
+        """
+        Write a single changeset record.
+        :param change: the CellChange the record is for
+        :param change_type: 'update', 'append', 'reset' or 'date-column'
+        :return: None
+        """
+        key, key_type = encode_value(change.key)
+        new, new_type = encode_value(change.value)
+        old, old_type = encode_value(change.old)
+        record = [self.tab, key, key_type, change.header, old, new, new_type, change_type]
+
+        if self.csv is not None:
+            self.csv.writerow(record)
+        else:
+            self.file.write(json.dumps(dict(zip(self.fields, record))) + '\n')
+
+    def mark(self):
+        """
+        Remember how much has been written so far, the changes written after it can be taken back with rollback.
+        :return: the position to pass to rollback
+        """
+        self.file.flush()
+        return self.file.tell(), self.count, self.updated, self.appended
+
+    def rollback(self, mark):
+        """
+        Take back everything written since mark was called.
+        :param mark: the position returned by mark
+        :return: None
+        """
+        position, self.count, self.updated, self.appended = mark
+        self.file.seek(position)
+        self.file.truncate()
+
+    def close(self):
+        """
+        Finish writing the changeset.
+        :return: None
+        """
+        self.file.close()
+
+
+def encode_value(value):
+    """
+    Turn a cell value into something JSON and CSV can hold.
+    :param value: the cell value
+    :return: (encoded value, type name or '' for strings)
+    """
+    if value is None:
+        return None, 'none'  # CSV cannot tell an empty cell from an empty string
+    if isinstance(value, str):
+        return value, ''
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat(), type(value).__name__
+
+    return value, type(value).__name__
+
+
+def decode_value(value, type_name):
+    """
+    Reverse encode_value.
+    :param value: the encoded value, CSV hands everything back as a string
+    :param type_name: the type name recorded by encode_value
+    :return: the cell value
+    """
+    if type_name == '':
+        return value
+    if type_name == 'none':
+        return None
+    if type_name == 'datetime':
+        return datetime.fromisoformat(value)
+    if type_name == 'date':
+        return date.fromisoformat(value)
+    if type_name == 'time':
+        return time.fromisoformat(value)
+    if type_name == 'bool':
+        return value in (True, 'True')
+    if type_name == 'int':
+        return int(value)
+    if type_name == 'float':
+        return float(value)
+
+    return value
+
+
+def read_changeset(fn):
+    """
+    Stream the records of a changeset written by ChangesetWriter.
+    :param fn: the JSONL or CSV file to read
+    :return: generator of dictionaries with the ChangesetWriter.fields, key and new decoded
+    """
+    with open(fn, newline='', encoding='utf-8') as f:
+        if fn.lower().endswith('.csv'):
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+
+        for record in records:
+            record['key'] = decode_value(record['key'], record['key_type'])
+            record['new'] = decode_value(record['new'], record['new_type'])
+            yield record
+
+
+# a header cell of a dump read by one of the DUMP_READERS, only the value is used
+HeaderCell = namedtuple('HeaderCell', 'value')
+
+# CSV holds everything as text, plain integers and decimals are turned back into numbers so they compare equal to
+# the destination. Numbers with leading zeros are left alone as they are usually identifiers
+CSV_NUMBER = re.compile(r'-?(0|[1-9][0-9]*)(\.[0-9]+)?$')
+
+
+class DumpSheet(ABC):
+    # rows are streamed from the file so the row count is not known up front, iter_rows reads to the end
+    max_row = None
+
+    def __init__(self, fn):
+        """
+        Base class for dump files that are not xlsx workbooks. Provides the part of the openpyxl read-only worksheet
+        that the sync uses: title, ws[1] for the header row and iter_rows(values_only=True). Subclasses implement
+        read_headers and read_rows.
+        :param fn: the dump file to read
+        """
+        self.fn = fn
+        self.title = path.splitext(path.basename(fn))[0]
+        self.headers = self.read_headers()
+
+    def __getitem__(self, row):
+        if row != 1:
+            raise IndexError('[{}] only the header row can be read directly'.format(self.fn.upper()))
+        return tuple(HeaderCell(header) for header in self.headers)
+
+    def iter_rows(self, min_row=1, max_row=None, min_col=1, max_col=None, values_only=True):
+        """
+        Stream rows like openpyxl's Worksheet.iter_rows, only columns min_col to max_col are read.
+        :param min_row: first row to return, the header is row 1
+        :param max_row: last row to return, None to read to the end of the file
+        :param min_col: first column to return
+        :param max_col: last column to return, None for the last header
+        :param values_only: must be True, there are no cell objects
+        :return: generator of tuples
+        """
+        if not values_only:
+            raise ValueError('[{}] rows can only be read as values'.format(self.fn.upper()))
+
+        max_col = len(self.headers) if max_col is None else max_col
+        width = max_col - min_col + 1
+        if min_row <= 1:
+            header = tuple(self.headers[min_col - 1:max_col])
+            yield header + (None,) * (width - len(header))
+            if max_row == 1:
+                return
+
+        rows = self.read_rows(min_col, max_col)
+        for row in islice(rows, max(min_row, 2) - 2, None if max_row is None else max_row - 1):
+            yield row if len(row) == width else tuple(row) + (None,) * (width - len(row))
+
+    @abstractmethod
+    def read_headers(self):
+        """
+        Read the column headers.
+        :return: list of headers
+        """
+
+    @abstractmethod
+    def read_rows(self, min_col, max_col):
+        """
+        Stream the data rows (everything after the header) reading only columns min_col to max_col.
+        :param min_col: first column to read
+        :param max_col: last column to read
+        :return: iterable of tuples
+        """
+
+
+class CsvDumpSheet(DumpSheet):
+    def read_headers(self):
+        with open(self.fn, newline='', encoding='utf-8-sig') as f:
+            return next(csv.reader(f), [])
+
+    def read_rows(self, min_col, max_col):
+        with open(self.fn, newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                yield tuple(self.csv_value(value) for value in row[min_col - 1:max_col])
+
+    @staticmethod
+    def csv_value(value):
+        """
+        Convert a CSV field to the value openpyxl would have read from the same cell in a workbook.
+        :param value: the field as text
+        :return: None for empty fields, a number for plain integers and decimals, otherwise the text
+        """
+        if value == '':
+            return None
+        if CSV_NUMBER.match(value):
+            return float(value) if '.' in value else int(value)
+
+        return value
+
+
+class ParquetDumpSheet(DumpSheet):
+    batch_size = 65536  # rows decoded at a time, bounds memory use for very large files
+
+    def read_headers(self):
+        if pq is None:
+            raise ImportError('pyarrow is required to read parquet dump files (pip install pyarrow)')
+        return pq.ParquetFile(self.fn).schema_arrow.names
+
+    def read_rows(self, min_col, max_col):
+        # only the requested columns are decoded, parquet is stored by column
+        columns = list(range(min_col - 1, min(max_col, len(self.headers))))
+        if len(columns) == 0:
+            return
+
+        parquet = pq.ParquetFile(self.fn)
+        for batch in parquet.iter_batches(batch_size=self.batch_size, columns=[self.headers[x] for x in columns]):
+            yield from zip(*(batch.column(x).to_pylist() for x in range(batch.num_columns)))
+
+
+class SnapshotSheet(DumpSheet):
+    def __init__(self, fn, title, rows):
+        """
+        A worksheet restored from the SnapshotCache, all of its values are held in memory.
+        :param fn: the workbook the sheet was read from
+        :param title: the worksheet title
+        :param rows: list of row value tuples, the header first
+        """
+        self.rows = rows
+        super().__init__(fn)
+        self.title = title
+        self.max_row = len(rows)
+
+    def read_headers(self):
+        return list(self.rows[0]) if len(self.rows) > 0 else []
+
+    def read_rows(self, min_col, max_col):
+        return (row[min_col - 1:max_col] for row in islice(self.rows, 1, None))
+
+
+class DumpWorkbook:
+    def __init__(self, *sheets):
+        """
+        Holds DumpSheets where the sync expects a workbook, the first sheet is the active worksheet.
+        :param sheets: the DumpSheets
+        """
+        self.worksheets = list(sheets)
+        self.active = self.worksheets[0]
+        self.iso_dates = True
+
+    def __getitem__(self, title):
+        for ws in self.worksheets:
+            if ws.title == title:
+                return ws
+        raise KeyError('Worksheet {} does not exist.'.format(title))
+
+    def close(self):
+        pass
+
+
+class SnapshotCache:
+    def __init__(self, directory, max_bytes):
+        """
+        On-disk cache of the cell values of parsed workbooks so openpyxl only parses an unchanged file once.
+        Entries are pickled lists of row tuples keyed by the file's path and a hash of its content, the least
+        recently used entries are removed once the cache grows past max_bytes. Entries are unpickled when read, so
+        anyone who can write to the directory can run code as the user running the sync. The directory is created
+        private to the user, point it only at directories nobody else can write to.
+        :param directory: where cache entries are kept, created when first needed
+        :param max_bytes: the size the cache is trimmed back to after each new entry
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def entry(self, fn):
+        """
+        The cache file for the current content of fn.
+        :param fn: the workbook
+        :return: path of the cache entry, which may not exist
+        """
+        digest = sha256(path.abspath(fn).encode('utf-8'))
+        digest.update(file_digest(fn).encode('ascii'))
+        return path.join(self.directory, digest.hexdigest() + '.pickle')
+
+    def open_workbook(self, fn):
+        """
+        Load the values of every worksheet in a workbook from the cache, parsing and caching the workbook on a miss.
+        :param fn: the workbook to open
+        :return: DumpWorkbook of SnapshotSheets, the active worksheet first
+        """
+        return snapshot_workbook(fn, self.read(fn))
+
+    def read(self, fn):
+        """
+        Same as open_workbook but returns the plain values.
+        :param fn: the workbook to read
+        :return: list of (title, rows) for each worksheet, the active worksheet first
+        """
+        entry = self.entry(fn)
+        try:
+            with open(entry, 'rb') as f:
+                sheets = pickle.load(f)
+            utime(entry)  # the modification time is what marks an entry as recently used
+            self.hits += 1
+        except (OSError, EOFError, pickle.UnpicklingError):
+            sheets = self.store(fn, entry)
+            self.misses += 1
+
+        return sheets
+
+    def store(self, fn, entry):
+        """
+        Parse a workbook with openpyxl's read-only reader and write its values to the cache.
+        :param fn: the workbook to parse
+        :param entry: the cache entry to write
+        :return: list of (title, rows) for each worksheet, the active worksheet first
+        """
+        sheets = read_workbook_values(fn)
+        makedirs(self.directory, 0o700, exist_ok=True)
+        handle, fn_temp = mkstemp(suffix='.pickle', dir=self.directory)
+        close(handle)
+        try:
+            with open(fn_temp, 'wb') as f:
+                pickle.dump(sheets, f, pickle.HIGHEST_PROTOCOL)
+            replace(fn_temp, entry)  # other processes may be reading the same entry
+        except OSError:
+            if path.exists(fn_temp):
+                remove(fn_temp)
+            raise
+
+        self.evict()
+        return sheets
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        :return: None
+        """
+        entries = []
+        for fn in listdir(self.directory):
+            if fn.endswith('.pickle'):
+                try:
+                    entries.append((path.getmtime(path.join(self.directory, fn)),
+                                    path.getsize(path.join(self.directory, fn)), fn))
+                except OSError:  # removed by another process
+                    continue
+
+        total = 0
+        for mtime, size, fn in sorted(entries, reverse=True):  # newest first
+            total += size
+            if total > self.max_bytes:
+                try:
+                    remove(path.join(self.directory, fn))
+                except OSError:
+                    continue
+
+
+def default_cache_directory():
+    """
+    The per-user directory the snapshot cache is kept in when --cache is given without one.
+    :return: excelpy under %LOCALAPPDATA% on Windows, otherwise under $XDG_CACHE_HOME or ~/.cache
+    """
+    if name == 'nt' and environ.get('LOCALAPPDATA'):
+        return path.join(environ['LOCALAPPDATA'], 'excelpy')
+
+    return path.join(environ.get('XDG_CACHE_HOME') or path.join(path.expanduser('~'), '.cache'), 'excelpy')
+
+
+def read_workbook_values(fn):
+    """
+    Parse a workbook with openpyxl's read-only reader and keep only its values.
+    :param fn: the workbook to parse
+    :return: list of (title, rows) for each worksheet, the active worksheet first
+    """
+    wb = load_workbook(fn, read_only=True)
+    try:
+        active = wb.active
+        return [(ws.title, list(ws.iter_rows(values_only=True)))
+                for ws in [active] + [ws for ws in wb.worksheets if ws is not active]]
+    finally:
+        wb.close()
+
+
+def snapshot_workbook(fn, sheets):
+    """
+    Wrap the values read by read_workbook_values in a workbook.
+    :param fn: the workbook the values were read from
+    :param sheets: list of (title, rows) for each worksheet, the active worksheet first
+    :return: DumpWorkbook of SnapshotSheets
+    """
+    return DumpWorkbook(*(SnapshotSheet(fn, title, rows) for title, rows in sheets))
+
+
+def file_digest(fn):
+    """
+    Hash the content of a file.
+    :param fn: the file to hash
+    :return: sha256 hex digest
+    """
+    digest = sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+# dump file readers by file extension, anything else is read as an xlsx workbook. Register a DumpSheet subclass here
+# to sync another format
+DUMP_READERS = {'.csv': CsvDumpSheet, '.parquet': ParquetDumpSheet}
+
+
+def load_dump(fn, read_only=False, cache=None):
+    """
+    Open a dump file with the reader registered for its extension.
+    :param fn: the dump file to open
+    :param read_only: open xlsx workbooks with the read-only (streaming) reader, other formats always stream
+    :param cache: SnapshotCache used for xlsx workbooks, None to always parse them
+    :return: a workbook whose active worksheet holds the dump
+    """
+    reader = DUMP_READERS.get(path.splitext(fn)[1].lower())
+    if reader is None and cache is not None:
+        return cache.open_workbook(fn)
+    if reader is None:
+        return load_workbook(fn, read_only=read_only)
+
+    return DumpWorkbook(reader(fn))
+
+
+class WorksheetIndex:
+    def __init__(self, ws, rows=None, cols=None):
+        """
+        Build a lookup of primary key -> row and column header -> column for a worksheet so that
+        individual cells can be located without rescanning the sheet.
+        :param ws: the worksheet to index
+        :param rows: primary key -> first row, when already known from ExcelPY.scan_worksheet
+        :param cols: column header -> first column, when already known from ExcelPY.scan_worksheet
+        """
+        self.ws = ws
+        self.rows = rows  # primary key -> first row containing that key
+        self.cols = cols  # column header -> first column containing that header
+
+        if self.cols is None:
+            self.cols = {}
+            for x, cell in enumerate(ws[1]):
+                self.cols.setdefault(cell.value, x + 1)
+
+        if self.rows is None:
+            self.rows = {}
+            for x, row in enumerate(ws.iter_rows(2, ws.max_row, 1, 1, values_only=True)):
+                self.rows.setdefault(row[0], x + 2)
+
+    def add_cell(self, cell):
+        """
+        Keep the index in step with the worksheet after a cell has been written.
+        :param cell: the cell that was written
+        :return: None
+        """
+        if cell.column == 1 and cell.row > 1:
+            self.rows.setdefault(cell.value, cell.row)
+
+    def get_cell_details(self, primary_key, header_name):
+        """
+        Same contract as ExcelPY.get_cell_details but resolved with dictionary lookups.
+        :param primary_key: the key field to search
+        :param header_name: the column header to search
+        :return: dictionary of results
+        """
+        results = {'cell_found': False, 'key_found': False, 'grid_found': False}
+
+        row = self.rows.get(primary_key)
+        if row is None:
+            return results
+
+        results['key_found'] = True
+        col = self.cols.get(header_name)
+        if col is None:
+            return results
+
+        results['grid_found'] = True
+        results['row'] = row
+        results['col'] = col
+        value = self.ws.cell(row=row, column=col).value
+        if value is not None:  # true if there is a value at grid location
+            results['value'] = value
+            results['cell_found'] = True
+
+        return results
+
+
+def sqlite_value(value):
+    """
+    Store a cell value in SQLite so that equal values stay equal. Text and numbers are stored as they are,
+    anything else (dates, booleans, ...) is pickled.
+    :param value: the cell value
+    :return: the value to store
+    """
+    if value is None or isinstance(value, (str, float)) or (type(value) is int and -2 ** 63 <= value < 2 ** 63):
+        return value
+
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def python_value(value):
+    """
+    Reverse sqlite_value.
+    :param value: the stored value
+    :return: the cell value
+    """
+    return pickle.loads(value) if isinstance(value, bytes) else value
+
+
+class RecordStore:
+    __slots__ = ('headers', 'cols', 'positions', 'rows', 'values')
+
+    def __init__(self, headers, cols):
+        """
+        Compact store of the values of a worksheet, one tuple of values per primary key in header order. Row numbers
+        are held once per key and column numbers once per header instead of once per cell.
+        :param headers: the column headers that are stored
+        :param cols: column number of each header in the worksheet, None if the sheet does not have it
+        """
+        self.headers = headers
+        self.cols = cols
+        self.positions = {}  # primary key -> position in rows and values
+        self.rows = []  # row number of each key
+        self.values = []  # tuple of values of each key, None for empty cells
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def add(self, key, row, values):
+        """
+        Store the values of a key.
+        :param key: the primary key
+        :param row: the row the values were read from
+        :param values: tuple of values in header order
+        :return: None
+        """
+        self.positions[key] = len(self.rows)
+        self.rows.append(row)
+        self.values.append(values)
+
+    def get(self, key, default=None):
+        """
+        Get the values stored for a key.
+        :param key: the primary key
+        :param default: returned when the key is not stored
+        :return: (row, tuple of values in header order), or default
+        """
+        position = self.positions.get(key)
+        if position is None:
+            return default
+
+        return self.rows[position], self.values[position]
+
+
+class IndexedRecords:
+    __slots__ = ('index', 'headers', 'cols')
+
+    def __init__(self, index, headers):
+        """
+        The destination values a RecordStore would hold, read from the cells of an indexed worksheet when a key is
+        looked up instead of by scanning the whole worksheet.
+        :param index: WorksheetIndex of the worksheet
+        :param headers: the column headers that are read
+        """
+        self.index = index
+        self.headers = headers
+        self.cols = tuple(index.cols.get(d) for d in headers)
+
+    def __contains__(self, key):
+        return key in self.index.rows
+
+    def get(self, key, default=None):
+        """
+        Read the values of a key.
+        :param key: the primary key
+        :param default: returned when the key is not in the worksheet
+        :return: (row, tuple of values in header order), or default
+        """
+        row = self.index.rows.get(key)
+        if row is None:
+            return default
+
+        ws = self.index.ws
+        return row, tuple(ws.cell(row=row, column=col).value if col is not None else None for col in self.cols)
+
+    def store(self, keys):
+        """
+        Read the values of some keys into a RecordStore.
+        :param keys: the primary keys to read
+        :return: RecordStore, keys with nothing in the headers' columns are left out like scan_worksheet does
+        """
+        records = RecordStore(self.headers, self.cols)
+        for key in keys:
+            record = self.get(key)
+            if record is not None and record[1].count(None) < len(record[1]):
+                records.add(key, *record)
+
+        return records
 
 
 class ExcelPY:
@@ -18,6 +863,11 @@ class ExcelPY:
         self.start_time = datetime.now()  # start timer before first operation
         self.end_time = datetime.now()  # end timer after last operation
         self.execution_time = datetime.now()  # results of our timer
+        self.save_time = timedelta()  # time spent writing the destination workbook
+        self.timings = {}  # seconds spent in each phase, keyed by destination tab then phase ('run' for the whole run)
+        self.counts = {}  # cells compared/written, style assignments and peak memory so far, keyed by destination tab
+        self.date_columns = {}  # destination tab -> date column headers found by the last diff of that tab
+        self.style_cache = {}  # (workbook, fill, font, starting style) -> resulting cell style
 
         # filenames for our workbooks (spreadsheets)
         self.fn_alm = 'dump-alm.xlsx'
@@ -25,6 +875,7 @@ class ExcelPY:
         self.fn_enhancement = 'dump-enhancements.xlsx'
         self.fn_incident = 'dump-incidents.xlsx'
         self.fn_destination = 'capacity-tracker.xlsx'
+        self.fn_manifest = 'excelpy-manifest.json'  # fingerprints from the last sync used by --incremental
 
         # workbook handles
         self.wb_alm = Workbook()
@@ -33,17 +884,41 @@ class ExcelPY:
         self.wb_incident = Workbook()
         self.wb_destination = Workbook()
 
+        # key/header indexes for worksheets, built once per sheet
+        self.ws_indexes = {}
+
         # user supplied options (arguments)
         self.arg_data = False  # generate test data only
         self.arg_check = False  # allows us to run the app to test files without writing to them
+        self.arg_stream = False  # open dump files read-only and stream their rows
+        self.arg_load_jobs = 1  # worker processes used to parse the dump workbooks
+        self.arg_jobs = 1  # number of worker processes used to sync the dump files
+        self.arg_incremental = False  # skip dump files and rows that have not changed since the last sync
+        self.arg_engine = 'python'  # 'python' diffs row by row, 'numpy' whole columns at once, 'sqlite' on disk
+        self.arg_metrics = None  # file name the metrics report is written to
+        self.arg_export = None  # write the changes to this JSONL/CSV file instead of the destination
+        self.arg_apply = None  # apply a changeset written by --export to the destination
+        self.arg_write_only = False  # rebuild the destination with the write-only writer instead of editing it
+        self.arg_watch = None  # seconds between checks of the dump files when running in watch mode
+        self.watch_debounce = 5.0  # seconds a changed dump file must stay unchanged before it is synced
+        self.cache = None  # SnapshotCache of parsed workbooks, only used when --cache is given
+        self.destination_state = None  # file_state of the destination when watch mode last loaded or saved it
 
         # general application options
         self.date_fields = ['opened', 'planned fix date']
+        self.duplicate_limit = 20  # a sheet is no longer scanned once this many duplicate keys have been found
+        self.date_sample_size = 50  # how many dump rows are sampled when deciding which columns hold dates
         self.test_data_row_count = 3  # how many rows of test data we will be creating
+        self.test_data_seed = None  # seed for the test data generator so fixtures can be reproduced
+        self.test_data_overlap = 1.0  # fraction of dump keys that also exist in the destination
         self.cells_updated = 0  # number of cells that were updated
         self.rows_appended = 0  # number of rows that were appended
         self.errors = 0  # how many errors were encountered
         self.warnings = 0  # counter for how many warnings were generated
+        self.log_buffer = None  # when a list, messages are collected here instead of printed
+        self.log = LogSink()  # where messages are printed, replaced when --quiet or --log-file are given
+        self.manifest = None  # fingerprints loaded from fn_manifest when running incrementally
+        self.manifest_updates = {}  # fingerprints recorded during this run, keyed by dump file name
 
     def __del__(self):
         """
@@ -51,237 +926,1194 @@ class ExcelPY:
         :return: None
         """
         self.close_files()
+        self.log.close()
+
+    def open_workbooks(self, read_only_dumps=False, skip=(), read_only_destination=False):
+        """
+        Open files needed to perform our processes. Unless they are streamed, dump workbooks are parsed by up to
+        arg_load_jobs worker processes while the destination is loaded here. A file that can not be opened is
+        reported and the others are still loaded.
+        :param read_only_dumps: open the dump files with the read-only (streaming) reader
+        :param skip: dump file names that should not be loaded
+        :param read_only_destination: open the destination file with the read-only (streaming) reader
+        :return: boolean, False if any file could not be opened
+        """
+        loaded = True
+        workbooks = {}
+        dumps = [fn_dump for fn_dump, tab in self.dump_tabs() if fn_dump not in skip]
+
+        # streamed and non-xlsx dumps open instantly, their rows are only read during the diff
+        pooled = []
+        if self.arg_load_jobs > 1 and not read_only_dumps:
+            pooled = [fn_dump for fn_dump in dumps if path.splitext(fn_dump)[1].lower() not in DUMP_READERS]
+
+        pool = None
+        futures = {}
+        if len(pooled) > 1:
+            cache = (self.cache.directory, self.cache.max_bytes) if self.cache is not None else None
+            pool = ProcessPoolExecutor(max_workers=min(self.arg_load_jobs, len(pooled)))
+            futures = {fn_dump: pool.submit(load_worker, fn_dump, cache) for fn_dump in pooled}
+
+        try:
+            try:
+                if read_only_destination and self.cache is not None:
+                    self.wb_destination = self.cache.open_workbook(self.fn_destination)
+                else:
+                    self.wb_destination = load_workbook(self.fn_destination, read_only=read_only_destination)
+                self.wb_destination.iso_dates = True
+            except Exception as e:
+                self.error('[{}] {}'.format(self.fn_destination.upper(), str(e)))
+                loaded = False
+
+            for fn_dump in dumps:
+                try:
+                    if fn_dump in futures:
+                        sheets, hits, misses = futures[fn_dump].result()
+                        workbooks[fn_dump] = snapshot_workbook(fn_dump, sheets)
+                        if self.cache is not None:  # the worker had its own copy of the cache
+                            self.cache.hits += hits
+                            self.cache.misses += misses
+                    else:
+                        workbooks[fn_dump] = load_dump(fn_dump, read_only_dumps, self.cache)
+                    workbooks[fn_dump].iso_dates = True
+                except Exception as e:
+                    self.error('[{}] {}'.format(fn_dump.upper(), str(e)))
+                    loaded = False
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        self.wb_alm = workbooks.get(self.fn_alm, self.wb_alm)
+        self.wb_defect = workbooks.get(self.fn_defect, self.wb_defect)
+        self.wb_enhancement = workbooks.get(self.fn_enhancement, self.wb_enhancement)
+        self.wb_incident = workbooks.get(self.fn_incident, self.wb_incident)
+
+        if self.cache is not None:
+            self.add_count('run', 'cache_hits', self.cache.hits)
+            self.add_count('run', 'cache_misses', self.cache.misses)
+        return loaded
+
+    def close_files(self):
+        """
+        Close all of the files that we used.
+        :return: None
+        """
+        self.wb_alm.close()
+        self.wb_defect.close()
+        self.wb_enhancement.close()
+        self.wb_incident.close()
+        self.wb_destination.close()
+
+    def generate_test_data(self):
+        """
+        Populate our input file with random test data. Every dump key is unique, test_data_overlap controls how
+        many of them are also written to the destination (updates) and how many are left for the sync to append.
+        :return: None
+        """
+        self.message('Generating {} rows of unique keyed test data.'.format(self.test_data_row_count))
+        try:
+            self.wb_destination = load_workbook(self.fn_destination)
+        except Exception as e:
+            self.error(str(e))
+            exit()
+
+        rng = Random(self.test_data_seed)
+
+        # populate our data dump input files
+        self.populate_sheet(self.fn_incident, 'Hypercare Incidents', 'INC', rng)
+        self.populate_sheet(self.fn_enhancement, 'Hypercare Enhancements', 'ENH', rng)
+        self.populate_sheet(self.fn_defect, 'Hypercare Defects', 'DFC', rng)
+        self.populate_sheet(self.fn_alm, 'ALM Defects', 'ALM', rng)
+
+        self.save_destination()
+        self.message('Completed generating input file')
+
+    def populate_sheet(self, fn, tab, extra, rng):
+        """
+        Create test data. The dump file is rebuilt with a write-only workbook, keeping its sheet title and header
+        row, and the matching destination tab is cleared and refilled.
+        :param fn: the dump file to overwrite
+        :param tab: name of the destination tab (sheet) to write to
+        :param extra: extra info to add to the generated data
+        :param rng: random.Random used for every generated value
+        :return: None
+        """
+        ws_dest = self.wb_destination[tab]
+        used = set()  # every generated value is unique, not just the keys
+
+        try:
+            wb_source = load_workbook(fn, read_only=True)
+            title = wb_source.active.title
+            headers = []
+            for cell in wb_source.active[1]:
+                if cell.value is None:  # no idea why but some sheets not reporting column count correctly.
+                    break
+                headers.append(cell)
+            wb_source.close()
+
+            dest_headers = []
+            for cell in ws_dest[1]:
+                if cell.value is None:
+                    break
+                dest_headers.append(cell.value)
+
+            # the destination gets the overlapping dump keys plus its own keys, in random order
+            dump_keys = [self.random_test_value(rng, extra, used) for x in range(self.test_data_row_count)]
+            shared = int(round(self.test_data_row_count * self.test_data_overlap))
+            dest_keys = dump_keys[:shared] + [self.random_test_value(rng, extra, used)
+                                              for x in range(self.test_data_row_count - shared)]
+            rng.shuffle(dest_keys)
+
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet(title)
+            for x in range(1, len(headers) + 1):  # column widths have to be set before the first row
+                ws.column_dimensions[get_column_letter(x)].width = 18
+
+            header_row = []
+            for cell in headers:
+                header = WriteOnlyCell(ws, value=cell.value)
+                header.font = cell.font
+                header.fill = cell.fill
+                header.border = cell.border
+                header.alignment = cell.alignment
+                header.number_format = cell.number_format
+                header_row.append(header)
+            ws.append(header_row)
+
+            dump_dates = [str(cell.value).lower() in self.date_fields for cell in headers]
+            for key in dump_keys:
+                ws.append([key] + [self.random_test_value(rng, extra, used, is_date) for is_date in dump_dates[1:]])
+            wb.save(fn)
+
+            # this loop is for the destination file
+            ws_dest.delete_rows(2, ws_dest.max_row + 1)
+            dest_dates = [str(header).lower() in self.date_fields for header in dest_headers]
+            for x, key in enumerate(dest_keys):
+                ws_dest.cell(row=x + 2, column=1, value=key)
+                for y, is_date in enumerate(dest_dates[1:]):
+                    ws_dest.cell(row=x + 2, column=y + 2, value=self.random_test_value(rng, extra, used, is_date))
+
+            for x in range(1, len(dest_headers) + 1):
+                ws_dest.column_dimensions[get_column_letter(x)].width = 18
+
+        except Exception as e:
+            self.error(str(e))
+
+    def random_test_value(self, rng, extra, used, is_date=False):
+        """
+        Generate a single test data value.
+        :param rng: random.Random to draw from
+        :param extra: extra info to add to the generated data
+        :param used: set of values already handed out, updated in place
+        :param is_date: generate a date within a few weeks of today instead
+        :return: string
+        """
+        self.is_not_used()
+        if is_date:
+            return (date.today() + timedelta(days=rng.randint(-10, 35))).strftime('%Y-%m-%d')
+
+        while True:  # disallow duplicate values
+            pair = rng.randrange(99900 * 99900)  # one draw split into two numbers between 100 and 99999
+            buffer = '[%s] %05d:%05d' % (extra, 100 + pair // 99900, 100 + pair % 99900)
+            if buffer not in used:
+                used.add(buffer)
+                return buffer
+
+    def get_execution_time(self):
+        """
+        Display the results of our execution timer.
+        :return: None
+        """
+        self.execution_time = self.end_time - self.start_time
+
+        lines = ['**[OPERATION COMPLETE]**********************************************************************']
+        if self.arg_data:
+            lines.append(' Execution Time: {} ms'.format(self.execution_time))
+        else:
+            lines.append('   Cell Updates: {}'.format(self.cells_updated))
+            lines.append(' Cell Additions: {}'.format(self.rows_appended))
+            lines.append('         Errors: {}'.format(self.errors))
+            lines.append('       Warnings: {}'.format(self.warnings))
+            lines.append('      Save Time: {:.0f} ms'.format(self.save_time.total_seconds() * 1000))
+            lines.append(' Execution Time: {} ms'.format(self.execution_time))
+        lines.append('********************************************************************************************')
+
+        for x, line in enumerate(lines):  # the summary is shown even in quiet mode
+            self.log.write('summary', line, x == 0)
+        self.log.flush()
+
+    def start_timer(self):
+        """
+        Start our timer used to determine execution speed.
+        :return: None
+        """
+        self.start_time = datetime.now()
+
+    def stop_timer(self):
+        """
+        Stop our timer used to determine execution speed.
+        :return:
+        """
+        self.end_time = datetime.now()
+
+    def add_timing(self, tab, phase, start):
+        """
+        Add the time since start to a phase of our run.
+        :param tab: the destination tab the phase belongs to, 'run' for work that is not tied to a tab
+        :param phase: name of the phase, e.g. 'load', 'diff' or 'save'
+        :param start: datetime the phase started
+        :return: None
+        """
+        timings = self.timings.setdefault(tab, {})
+        timings[phase] = timings.get(phase, 0.0) + (datetime.now() - start).total_seconds()
+
+    def add_count(self, tab, counter, amount):
+        """
+        Add to one of the counters kept for a tab.
+        :param tab: the destination tab the counter belongs to
+        :param counter: name of the counter, e.g. 'cells_written'
+        :param amount: how much to add
+        :return: None
+        """
+        counts = self.counts.setdefault(tab, {})
+        counts[counter] = counts.get(counter, 0) + amount
+
+    def peak_memory(self):
+        """
+        Peak resident set size of this process and any worker processes that have finished.
+        :return: kilobytes, or None where the platform can not report it
+        """
+        self.is_not_used()
+        if resource is None:
+            return None
+
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        if platform == 'darwin':  # macOS reports bytes, Linux reports kilobytes
+            peak //= 1024
+        return peak
+
+    def record_peak_memory(self, tab):
+        """
+        Note the peak memory of the process so far against a tab. This is the process wide high-water mark once the
+        tab is done, which includes every tab processed before it, not the memory used by the tab itself. With
+        --jobs it is the high-water mark of the worker process that diffed the tab.
+        :param tab: the destination tab that was just processed
+        :return: None
+        """
+        self.counts.setdefault(tab, {})['peak_rss_so_far_kb'] = self.peak_memory()
+
+    def write_metrics(self):
+        """
+        Write the phase timings and counters collected during the run to the file given by --metrics.
+        :return: None
+        """
+        if self.arg_metrics is None:
+            return
+
+        tabs = {}
+        for tab in list(self.timings) + list(self.counts):
+            if tab != 'run':
+                tabs[tab] = {'timings': self.timings.get(tab, {}), 'counts': self.counts.get(tab, {})}
+
+        metrics = {'date': self.start_time.isoformat(),
+                   'execution_time': self.execution_time.total_seconds(),
+                   'cells_updated': self.cells_updated,
+                   'rows_appended': self.rows_appended,
+                   'errors': self.errors,
+                   'warnings': self.warnings,
+                   'peak_rss_kb': self.peak_memory(),
+                   'timings': self.timings.get('run', {}),
+                   'counts': self.counts.get('run', {}),
+                   'tabs': tabs}
+
+        try:
+            with open(self.arg_metrics, 'w') as f:
+                json.dump(metrics, f, indent=2)
+        except Exception as e:
+            self.error(str(e))
+
+    def is_not_used(self):
+        """
+        Useful to get rid of the warning messages about 'self' not being used in a method.
+        :return:
+        """
+        pass
+
+    def parse_args(self):
+        """
+        By default without args we will process the files, but we will also give options via
+        command line arguments for things like generating test data.
+        :return: None
+        """
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-d', '--data', dest='data',
+                            help='Generate requested amount of test data.',
+                            type=int, nargs='+')
+        parser.add_argument('--seed', dest='seed', help='Seed used when generating test data.',
+                            type=int, default=None)
+        parser.add_argument('--overlap', dest='overlap',
+                            help='Fraction of generated dump keys that also exist in the destination (0 to 1).',
+                            type=float, default=1.0)
+        parser.add_argument('-c', '--check', action='store_true',
+                            dest='check', help='Check files without modifying them.',
+                            default=False)
+        parser.add_argument('-s', '--stream', action='store_true',
+                            dest='stream', help='Open dump files read-only and stream their rows.',
+                            default=False)
+        parser.add_argument('-j', '--jobs', dest='jobs',
+                            help='Number of worker processes used to sync the dump files.',
+                            type=int, default=1)
+        parser.add_argument('-l', '--load-jobs', dest='load_jobs', type=int,
+                            help='Parse the dump workbooks in up to this many worker processes.',
+                            default=4)
+        parser.add_argument('-i', '--incremental', action='store_true',
+                            dest='incremental', help='Only sync dump files and rows that changed since the last run.',
+                            default=False)
+        parser.add_argument('-e', '--engine', dest='engine', choices=['python', 'numpy', 'sqlite'],
+                            help='Diff engine used to compare dump and destination tabs.',
+                            default='python')
+        parser.add_argument('-m', '--metrics', dest='metrics',
+                            help='Write phase timings and counters for each tab to this JSON file.',
+                            default=None)
+        parser.add_argument('-f', '--format', dest='format', choices=['xlsx', 'csv', 'parquet'],
+                            help='File format of the dump files, e.g. dump-alm.csv for csv.',
+                            default='xlsx')
+        parser.add_argument('-w', '--watch', dest='watch', type=float, nargs='?', const=60.0,
+                            help='Keep running and re-sync a tab whenever its dump file changes, checking every '
+                                 'WATCH seconds (default 60).',
+                            default=None)
+        parser.add_argument('--debounce', dest='debounce', type=float,
+                            help='Seconds a changed dump file must stay unchanged before watch mode syncs it.',
+                            default=5.0)
+        parser.add_argument('--cache', dest='cache', nargs='?', const=default_cache_directory(),
+                            help='Keep the values of parsed workbooks in this directory (default ~/.cache/excelpy) so '
+                                 'unchanged files are not parsed again. Cache entries are trusted, the directory '
+                                 'must not be writable by other users.',
+                            default=None)
+        parser.add_argument('--cache-size', dest='cache_size', type=int,
+                            help='Size in MB the snapshot cache is kept under.',
+                            default=512)
+        parser.add_argument('--export', dest='export',
+                            help='Write the changes to a .jsonl or .csv changeset instead of the destination file.',
+                            default=None)
+        parser.add_argument('--apply', dest='apply',
+                            help='Apply a changeset written by --export to the destination file.',
+                            default=None)
+        parser.add_argument('-q', '--quiet', action='store_true', dest='quiet',
+                            help='Only show errors and the final summary on the console.',
+                            default=False)
+        parser.add_argument('--log-file', dest='log_file',
+                            help='Also append every message, warning and error to this file.',
+                            default=None)
+        parser.add_argument('-o', '--write-only', action='store_true', dest='write_only',
+                            help='Save the destination by streaming every tab through the write-only writer instead '
+                                 'of editing the whole workbook in memory. Needs openpyxl 3.1 and refuses destinations '
+                                 'with comments, drawings, tables or chart sheets.',
+                            default=False)
+        args = parser.parse_args()
+        try:
+            self.log = LogSink('error' if args.quiet else 'message', args.log_file)
+        except Exception as e:
+            self.error(str(e))
+            exit()
+        self.arg_data = args.data
+        self.test_data_seed = args.seed
+        self.test_data_overlap = min(max(args.overlap, 0.0), 1.0)
+        self.arg_check = args.check
+        self.arg_stream = args.stream
+        self.arg_jobs = args.jobs
+        self.arg_load_jobs = max(args.load_jobs, 1)
+        self.arg_incremental = args.incremental
+        self.arg_engine = args.engine
+        self.arg_metrics = args.metrics
+        self.arg_export = args.export
+        self.arg_apply = args.apply
+        self.arg_write_only = args.write_only
+        self.arg_watch = args.watch
+        self.watch_debounce = max(args.debounce, 0.0)
+        if args.cache is not None:
+            self.cache = SnapshotCache(args.cache, args.cache_size * 1024 * 1024)
+        if args.format != 'xlsx' and not self.arg_data:  # test data is always generated as xlsx
+            self.set_dump_format(args.format)
+
+        if self.arg_watch is not None and (self.arg_export is not None or self.arg_apply is not None):
+            self.error('--watch writes the destination file and can not be combined with --export or --apply')
+            exit()
+
+        if xc.arg_data:  # did the user request to generate test data?
+            self.log.flush()
+            choice = input(Fore.YELLOW + 'This option will ' + Fore.RED +
+                           '*OVERWRITE ALL FILES* ' + Fore.YELLOW + 'you sure (y/n)? ')
+            if choice.upper() == 'Y':
+                self.test_data_row_count = int(self.arg_data[0])
+                xc.generate_test_data()
+            else:
+                xc.arg_data = False
+        elif self.arg_apply:
+            self.apply_changeset(self.arg_apply)
+        elif self.arg_watch is not None:
+            self.watch_dump_files(max(self.arg_watch, 0.1))
+        else:
+            self.process_dump_files()
+
+    def process_dump_files(self):
+        """
+        Process all the sheets in our workbooks looking for changes.
+        :return: None
+        """
+        if self.arg_engine == 'numpy' and np is None:
+            self.error('NumPy is required for --engine numpy (pip install numpy)')
+            exit()
+
+        if self.arg_incremental:
+            self.load_manifest()
+
+        # when neither the destination nor any dump changed since the last sync there is nothing to load or save
+        skipped = self.unchanged_dump_files()
+        if len(skipped) == len(self.dump_tabs()):
+            self.sync_dump_tabs(skipped, None)
+            return
+
+        if self.arg_write_only and self.arg_export is None and not self.write_only_supported():
+            exit()
+
+        if self.arg_jobs > 1:
+            self.process_dump_files_parallel(skipped)
+            return
+
+        # exporting never writes to the destination and write-only runs rebuild it from the file, so in both cases
+        # the destination can be opened read-only
+        start = datetime.now()
+        if not self.open_workbooks(self.arg_stream or self.arg_export is not None, skipped,
+                                   self.arg_export is not None or self.arg_write_only):
+            exit()
+        self.add_timing('run', 'load', start)
+
+        workbooks = {self.fn_incident: self.wb_incident,
+                     self.fn_defect: self.wb_defect,
+                     self.fn_enhancement: self.wb_enhancement,
+                     self.fn_alm: self.wb_alm}
+        self.sync_dump_tabs(skipped, lambda fn_dump, tab: (workbooks[fn_dump].active, None))
+
+    def sync_dump_tabs(self, skipped, prepare):
+        """
+        Write the changes of every dump tab that is not skipped, in the same order for serial and parallel runs, to
+        the --export changeset, the write-only rebuild or the destination workbook, then save the destination once.
+        :param skipped: list of dump file names that are unchanged since the last sync
+        :param prepare: called with (dump file name, destination tab name) and returns (ws_dump, changes), either the
+                        dump worksheet to diff now and None, or None and the changes already diffed for the tab, which
+                        are None when the tab can not be synced. Only called for tabs that are not skipped, the
+                        destination is not needed when every tab is skipped
+        :return: None
+        """
+        self.message('*****************************************************************************')
+        self.message('Only columns that exist in both the dump and destination file will be synced.')
+        self.message('They must also match exactly including spelling and capitalization.')
+        self.message('*****************************************************************************')
+
+        writer = self.open_changeset()
+        rebuilt = {} if self.arg_write_only else None  # destination tab -> changes, merged in when it is saved
+        for fn_dump, tab in self.dump_tabs():
+            if fn_dump in skipped:
+                self.message('SKIP: [{}] unchanged since the last sync'.format(fn_dump.upper()), True)
+                continue
+
+            ws_dump, changes = prepare(fn_dump, tab)
+            ws_dest = self.wb_destination[tab]
+            if ws_dump is None and changes is None:  # a worker could not sync the tab and has said why
+                continue
+
+            if writer is not None:
+                self.export_changes(writer, ws_dump, ws_dest, fn_dump, changes)
+            elif rebuilt is not None:
+                self.queue_changes(rebuilt, ws_dump, ws_dest, fn_dump, changes)
+            elif changes is not None:
+                self.apply_changes(ws_dest, fn_dump, changes)
+            else:
+                self.wb_destination.active = ws_dest
+                self.parse_dump_file(ws_dump, ws_dest, fn_dump)
+
+        if writer is not None:
+            writer.close()
+            return
+
+        # save our workbook with all changes, unless every tab was skipped and nothing could have changed
+        if not self.arg_check and len(skipped) < len(self.dump_tabs()):
+            if self.save_destination(rebuilt):  # a failed save leaves the old destination, keep the old manifest
+                self.save_manifest()
+
+    def open_changeset(self):
+        """
+        Open the --export changeset file if one was requested.
+        :return: ChangesetWriter, or None when the destination should be written directly
+        """
+        if self.arg_export is None:
+            return None
+
+        try:
+            return ChangesetWriter(self.arg_export)
+        except Exception as e:
+            self.error(str(e))
+            exit()
+
+    def export_changes(self, writer, ws_dump, ws_dest, fn_dump, changes=None):
+        """
+        Write the changes for one tab to a changeset, diffing the tab unless the changes are already known.
+        :param writer: the ChangesetWriter to write to
+        :param ws_dump: one of our dump workbooks that we will use as data input
+        :param ws_dest: the worksheet in our output file that should be compared
+        :param fn_dump: the name of the dump file being parsed
+        :param changes: list of CellChange from a worker process, None to diff the tab now
+        :return: None
+        """
+        updated = writer.updated
+        appended = writer.appended
+        writer.tab = ws_dest.title
+
+        if changes is None:
+            if self.diff_dump_file(ws_dump, ws_dest, fn_dump, writer) is None:
+                return
+        else:
+            for change in changes:
+                writer.append(change)
+        writer.write_date_columns(self.date_columns.get(ws_dest.title, []))
+
+        self.cells_updated += writer.updated - updated
+        self.rows_appended += writer.appended - appended
+        self.message('END: [{}]  [Updates: {}] [Additions: {}]'.format(fn_dump.upper(), writer.updated - updated,
+                                                                        writer.appended - appended))
+
+    def queue_changes(self, rebuilt, ws_dump, ws_dest, fn_dump, changes=None):
+        """
+        Diff a tab for a write-only run and keep its changes until the destination is rebuilt by save_destination.
+        :param rebuilt: dictionary of destination tab -> changes the changes are added to
+        :param ws_dump: one of our dump workbooks that we will use as data input
+        :param ws_dest: the worksheet in our output file that should be compared
+        :param fn_dump: the name of the dump file being parsed
+        :param changes: list of CellChange from a worker process, None to diff the tab now
+        :return: None
+        """
+        if changes is None:
+            changes = self.diff_dump_file(ws_dump, ws_dest, fn_dump)
+            if changes is None:
+                return
+
+        rows_updated = sum(1 for change in changes if change.kind == 'update')
+        rows_appended = sum(1 for change in changes if change.kind in ('append', 'new'))
+        rebuilt[ws_dest.title] = changes
+
+        self.cells_updated += rows_updated
+        self.rows_appended += rows_appended
+        self.add_count(ws_dest.title, 'cells_written', rows_updated + rows_appended)
+        self.add_count(ws_dest.title, 'style_assignments', len(changes))
+        self.message('END: [{}]  [Updates: {}] [Additions: {}]'.format(fn_dump.upper(), rows_updated, rows_appended))
+
+    def apply_changeset(self, fn):
+        """
+        Write a changeset produced by --export to the destination workbook in a single pass and save it once.
+        Cells are found by primary key and column header, keys that are not in the destination are appended.
+        :param fn: the JSONL or CSV changeset to apply
+        :return: None
+        """
+        start = datetime.now()
+        try:
+            self.wb_destination = load_workbook(self.fn_destination)
+            self.wb_destination.iso_dates = True
+        except Exception as e:
+            self.error(str(e))
+            exit()
+        self.add_timing('run', 'load', start)
+
+        self.message('APPLY: [{}] -> [{}]:'.format(fn.upper(), self.fn_destination.upper()), True)
+        start = datetime.now()
+        next_rows = {}  # destination tab -> next free row
+
+        try:
+            for record in read_changeset(fn):
+                tab = record['tab']
+                ws_dest = self.wb_destination[tab]
+                index = self.worksheet_index(ws_dest)
+                col = index.cols.get(record['column'])
+                if col is None:
+                    self.error('[{}] has no column \'{}\''.format(tab, record['column']))
+                    continue
+                if record['type'] == 'date-column':
+                    self.format_date_columns(ws_dest, [record['column']])
+                    continue
+
+                row = index.rows.get(record['key'])
+                if row is None and record['type'] == 'reset':  # the key is gone, there is nothing to clear
+                    continue
+                if row is None:  # append a new row for this key, the key always goes in the first column
+                    row = next_rows.get(tab, ws_dest.max_row + 1)
+                    next_rows[tab] = row + 1
+                    key = ws_dest.cell(row=row, column=1)
+                    self.format_cell_updated(key, record['key'])
+                    index.add_cell(key)
+
+                this = ws_dest.cell(row=row, column=col)
+                if record['type'] == 'update':
+                    self.cells_updated += 1
+                    self.format_cell_updated(this, record['new'])
+                elif record['type'] == 'append':
+                    self.rows_appended += 1
+                    self.format_cell_updated(this, record['new'])
+                    index.add_cell(this)
+                elif record['type'] == 'reset':
+                    self.format_cell_reset(this)
+        except Exception as e:
+            self.error(str(e))
+            return
+        self.add_timing('run', 'format', start)
+
+        self.message('END: [{}]  [Updates: {}] [Additions: {}]'.format(fn.upper(), self.cells_updated,
+                                                                        self.rows_appended))
+        if not self.arg_check:
+            self.save_destination()
+
+    def watch_dump_files(self, interval):
+        """
+        Keep the destination workbook and its key indexes loaded and re-sync a tab whenever its dump file changes,
+        so the load cost is paid once instead of on every run. Dump files are polled every interval seconds and
+        a change is only synced once every changed file has stayed unchanged for watch_debounce seconds, that way
+        a dump that is still being written is not read and all of the tabs changed in one burst are written with
+        a single save. Runs until interrupted with Ctrl+C.
+        :param interval: seconds between checks of the dump files
+        :return: None
+        """
+        if not self.load_destination():
+            exit()
+
+        seen = {fn_dump: self.file_state(fn_dump) for fn_dump, tab in self.dump_tabs()}
+        self.message('WATCH: [{}] every {} seconds, Ctrl+C to stop'.format(self.fn_destination.upper(), interval),
+                     True)
+        self.sync_tabs(self.dump_tabs())  # bring the destination up to date before waiting for changes
 
-    def open_workbooks(self):
+        pending = {}  # dump file name -> when it was last seen changing
+        try:
+            while True:
+                self.log.flush()
+                sleep(min(interval, self.watch_debounce) if pending else interval)
+
+                # the destination was changed by someone else, drop everything cached about it and start over
+                if self.file_state(self.fn_destination) != self.destination_state:
+                    self.warning('[{}] changed on disk, reloading it'.format(self.fn_destination.upper()))
+                    if not self.load_destination():
+                        exit()
+                    pending = {fn_dump: datetime.now() for fn_dump, tab in self.dump_tabs()}
+
+                for fn_dump, tab in self.dump_tabs():
+                    state = self.file_state(fn_dump)
+                    if state != seen[fn_dump]:
+                        seen[fn_dump] = state
+                        pending[fn_dump] = datetime.now()
+
+                if len(pending) == 0:
+                    continue
+                if (datetime.now() - max(pending.values())).total_seconds() < self.watch_debounce:
+                    continue
+
+                self.sync_tabs([(fn_dump, tab) for fn_dump, tab in self.dump_tabs() if fn_dump in pending])
+                pending = {}
+        except KeyboardInterrupt:
+            self.message('WATCH: stopped', True)
+
+    def load_destination(self):
         """
-        Open files needed to perform our processes.
+        Load the destination workbook for watch mode, forgetting indexes and styles cached for a previous copy.
         :return: boolean
         """
+        start = datetime.now()
         try:
-            self.wb_alm = load_workbook(self.fn_alm)
-            self.wb_defect = load_workbook(self.fn_defect)
-            self.wb_enhancement = load_workbook(self.fn_enhancement)
-            self.wb_incident = load_workbook(self.fn_incident)
             self.wb_destination = load_workbook(self.fn_destination)
-
-            self.wb_alm.iso_dates = True
-            self.wb_defect.iso_dates = True
-            self.wb_enhancement.iso_dates = True
-            self.wb_incident.iso_dates = True
             self.wb_destination.iso_dates = True
         except Exception as e:
             self.error(str(e))
             return False
 
+        self.ws_indexes = {}
+        self.style_cache = {}
+        self.destination_state = self.file_state(self.fn_destination)
+        self.add_timing('run', 'load', start)
         return True
 
-    def close_files(self):
+    def sync_tabs(self, tabs):
         """
-        Close all of the files that we used.
+        Re-sync destination tabs from their dump files against the destination workbook that is already loaded
+        and save it once.
+        :param tabs: list of (dump file name, destination tab name)
         :return: None
         """
-        self.wb_alm.close()
-        self.wb_defect.close()
-        self.wb_enhancement.close()
-        self.wb_incident.close()
-        self.wb_destination.close()
+        updated = self.cells_updated
+        appended = self.rows_appended
+
+        for fn_dump, tab in tabs:
+            try:
+                wb_dump = load_dump(fn_dump, True, self.cache)
+            except Exception as e:
+                self.error(str(e))
+                continue
+
+            try:
+                self.parse_dump_file(wb_dump.active, self.wb_destination[tab], fn_dump)
+            except Exception as e:
+                self.error(str(e))
+            finally:
+                wb_dump.close()
 
-    def generate_test_data(self):
-        """
-        Populate our input file with random test data. Due to the different number of columns in the files
-        and the random nature of this method there will likely be zero matching data between the files.
-        :return: None
-        """
-        self.message('Generating {} rows of unique keyed test data.'.format(self.test_data_row_count))
-        if not self.open_workbooks():
-            exit()
+        if not self.arg_check:
+            self.save_destination()
+            self.destination_state = self.file_state(self.fn_destination)
 
-        # populate our data dump input files
-        self.populate_sheet(self.wb_incident, self.wb_incident.active, self.fn_incident, 'Hypercare Incidents', 'INC')
-        self.populate_sheet(self.wb_enhancement, self.wb_enhancement.active, self.fn_enhancement,
-                            'Hypercare Enhancements', 'ENH')
-        self.populate_sheet(self.wb_defect, self.wb_defect.active, self.fn_defect, 'Hypercare Defects', 'DFC')
-        self.populate_sheet(self.wb_alm, self.wb_alm.active, self.fn_alm, 'ALM Defects', 'ALM')
+        self.message('SYNC: [{}] tab(s) at {} [Updates: {}] [Additions: {}]'.format(
+            len(tabs), datetime.now().strftime('%H:%M:%S'), self.cells_updated - updated,
+            self.rows_appended - appended), True)
 
-        self.message('Completed generating input file')
+    def file_state(self, fn):
+        """
+        Cheap check for changes to a file between two polls.
+        :param fn: the file to check
+        :return: (modification time, size), or None if the file does not exist
+        """
+        self.is_not_used()
+        try:
+            return path.getmtime(fn), path.getsize(fn)
+        except OSError:
+            return None
 
-    def populate_sheet(self, wb, ws, fn, tab, extra):
+    def set_dump_format(self, extension):
         """
-        Create test data.
-        :param wb: the workbook to be used
-        :param ws: the worksheet to be used
-        :param fn: the file name to save changes to
-        :param tab: name of the destination tab (sheet) to write to
-        :param extra: extra info to add to the generated data
+        Read the dump files in another format, e.g. dump-alm.csv instead of dump-alm.xlsx.
+        :param extension: file extension without the dot, one of the DUMP_READERS or xlsx
         :return: None
         """
-        ws.delete_rows(2, ws.max_row + 1)
-        self.wb_destination.active = self.wb_destination[tab]
-        self.wb_destination.active.delete_rows(2, self.wb_destination.active.max_row + 1)
-        used = []
+        self.fn_alm = path.splitext(self.fn_alm)[0] + '.' + extension
+        self.fn_defect = path.splitext(self.fn_defect)[0] + '.' + extension
+        self.fn_enhancement = path.splitext(self.fn_enhancement)[0] + '.' + extension
+        self.fn_incident = path.splitext(self.fn_incident)[0] + '.' + extension
 
-        try:
-            # this loop is for the dump file
-            for x in range(2, self.test_data_row_count + 2):  # now lets generate some cell data
-                for y in range(1, ws.max_column + 1):
-                    column_header = ws.cell(row=1, column=y).value
-                    if column_header is None:  # no idea why but some sheets not reporting column count correctly.
-                        break
-
-                    rand_x = randint(100, 99999)
-                    rand_y = randint(100, 99999)
-                    buffer = '[{}] {}:{}'.format(extra, str(rand_x).zfill(5), str(rand_y).zfill(5))
+    def dump_tabs(self):
+        """
+        The dump files and the destination tab each one is synced to, in processing order.
+        :return: list of (dump file name, destination tab name)
+        """
+        return [(self.fn_incident, 'Hypercare Incidents'),
+                (self.fn_defect, 'Hypercare Defects'),
+                (self.fn_enhancement, 'Hypercare Enhancements'),
+                (self.fn_alm, 'ALM Defects')]
 
-                    while used.count(buffer) != 0:  # disallow duplicate keys
-                        rand_x = randint(100, 99999)
-                        rand_y = randint(100, 99999)
-                        buffer = '[{}] {}:{}'.format(extra, str(rand_x).zfill(5), str(rand_y).zfill(5))
+    def file_signature(self, fn):
+        """
+        Describe a file's current state so it can be compared against the manifest on a later run.
+        :param fn: the file to describe
+        :return: dictionary with size, mtime and sha256
+        """
+        self.is_not_used()
+        return {'size': path.getsize(fn), 'mtime': path.getmtime(fn), 'sha256': file_digest(fn)}
 
-                    used.append(buffer)  # add our new key to the list
+    def file_unchanged(self, fn, signature):
+        """
+        Compare a file against a signature recorded by file_signature.
+        :param fn: the file to check
+        :param signature: the previously recorded signature, may be None
+        :return: boolean
+        """
+        if signature is None or not path.exists(fn):
+            return False
+        if path.getsize(fn) != signature['size']:
+            return False
+        if path.getmtime(fn) == signature['mtime']:
+            return True
 
-                    if column_header.lower() in self.date_fields:
-                        buffer = date.today() + timedelta(days=randint(-10, 35))
-                        buffer = self.format_date(buffer.strftime('%Y-%m-%d'))
+        return self.file_signature(fn)['sha256'] == signature['sha256']  # touched but possibly identical
 
-                    ws.cell(row=x, column=y).value = buffer
+    def load_manifest(self):
+        """
+        Load the fingerprints recorded by the last incremental sync.
+        :return: None
+        """
+        self.manifest = {'destination': None, 'dumps': {}}
+        if not path.exists(self.fn_manifest):
+            return
 
-                    if y == 1:  # only write to destination the first time through so keys match
-                        self.wb_destination.active.cell(row=x, column=1).value = buffer
+        try:
+            with open(self.fn_manifest) as f:
+                self.manifest = json.load(f)
+        except Exception as e:
+            self.warning('[{}] could not be read, running a full sync: {}'.format(self.fn_manifest.upper(), str(e)))
 
-                # this loop is for the destination file
-                for y in range(2, self.wb_destination.active.max_column + 1):
-                    column_header = self.wb_destination.active.cell(row=1, column=y).value
-                    if column_header is None:  # no idea why but some sheets not reporting column count correctly.
-                        break
+    def save_manifest(self):
+        """
+        Record file signatures and row fingerprints for the next incremental sync.
+        :return: None
+        """
+        if self.manifest is None:
+            return
 
-                    rand_x = randint(100, 99999)
-                    rand_y = randint(100, 99999)
-                    buffer = '[{}] {}:{}'.format(extra, str(rand_x).zfill(5), str(rand_y).zfill(5))
+        dumps = {}
+        for fn_dump, tab in self.dump_tabs():
+            if fn_dump in self.manifest_updates:
+                dumps[fn_dump] = self.manifest_updates[fn_dump]
+                dumps[fn_dump]['file'] = self.file_signature(fn_dump)
+            elif fn_dump in self.manifest['dumps']:  # skipped this run so carry the previous entry forward
+                dumps[fn_dump] = self.manifest['dumps'][fn_dump]
 
-                    while used.count(buffer) != 0:  # disallow duplicate keys
-                        rand_x = randint(100, 99999)
-                        rand_y = randint(100, 99999)
-                        buffer = '[{}] {}:{}'.format(extra, str(rand_x).zfill(5), str(rand_y).zfill(5))
+        try:
+            with open(self.fn_manifest, 'w') as f:
+                json.dump({'destination': self.file_signature(self.fn_destination), 'dumps': dumps}, f)
+        except Exception as e:
+            self.error(str(e))
 
-                    used.append(buffer)  # add our new key to the list
+    def unchanged_dump_files(self):
+        """
+        Find the dump files that can be skipped entirely because neither they nor the destination have changed
+        since the last sync, and the last sync left nothing highlighted in their tab.
+        :return: list of dump file names
+        """
+        skipped = []
+        if self.manifest is None or not self.file_unchanged(self.fn_destination, self.manifest['destination']):
+            return skipped
 
-                    if column_header.lower() in self.date_fields:
-                        buffer = date.today() + timedelta(days=randint(-10, 35))
-                        buffer = self.format_date(buffer.strftime('%Y-%m-%d'))
-                    else:
-                        buffer = '[{}] {}:{}'.format(extra, str(rand_x).zfill(5), str(rand_y).zfill(5))
+        for fn_dump, tab in self.dump_tabs():
+            entry = self.manifest['dumps'].get(fn_dump)
+            if entry is None or len(entry['touched']) > 0:
+                continue
+            if self.file_unchanged(fn_dump, entry['file']):
+                skipped.append(fn_dump)
 
-                    self.wb_destination.active.cell(row=x, column=y).value = buffer
+        return skipped
 
-            # now set the column widths
-            for x in range(1, ws.max_column + 1):
-                ws.column_dimensions[get_column_letter(x)].width = 18
+    def row_fingerprint(self, values):
+        """
+        Hash a row's values so unchanged rows can be recognized on the next incremental sync.
+        :param values: tuple of (header, value) pairs
+        :return: hex digest
+        """
+        self.is_not_used()
+        return blake2b(repr(values).encode(), digest_size=8).hexdigest()
 
-            for x in range(1, self.wb_destination.active.max_column + 1):
-                self.wb_destination.active.column_dimensions[get_column_letter(x)].width = 18
+    def save_destination(self, rebuilt=None):
+        """
+        Save the destination workbook once all tabs have been processed. The workbook is written to a temporary
+        file next to the destination and then renamed over it so a failed save never leaves a partial file.
+        :param rebuilt: dictionary of destination tab -> changes for a write-only run, the workbook is then rebuilt
+                        from the destination file by rebuild_destination instead of saved from memory
+        :return: boolean, False if the destination could not be saved
+        """
+        start = datetime.now()
+        saved = True
 
-        except IndexError as e:
-            self.error(str(e))
+        handle, fn_temp = mkstemp(suffix='.xlsx', dir=path.dirname(path.abspath(self.fn_destination)))
+        close(handle)
+        try:
+            if rebuilt is None:
+                # set the active worksheet so it opens on this tab
+                self.wb_destination.active = self.wb_destination['Hypercare Incidents']
+                self.wb_destination.save(fn_temp)
+            else:
+                self.rebuild_destination(fn_temp, rebuilt)
+            if path.exists(self.fn_destination):  # mkstemp files are private so keep the original permissions
+                chmod(fn_temp, stat(self.fn_destination).st_mode)
+            replace(fn_temp, self.fn_destination)
         except Exception as e:
             self.error(str(e))
+            if path.exists(fn_temp):
+                remove(fn_temp)
+            saved = False
 
-        wb.save(fn)
-        self.wb_destination.active = self.wb_destination['Hypercare Incidents']
-        self.wb_destination.save(self.fn_destination)
+        self.save_time += datetime.now() - start
+        self.add_timing('run', 'save', start)
+        return saved
 
-    def get_execution_time(self):
+    def write_only_supported(self):
         """
-        Display the results of our execution timer.
-        :return: None
+        Check that the destination can be rebuilt by rebuild_destination without losing anything, before any dump
+        file is read. The rebuild relies on openpyxl internals so it needs one of the WRITE_ONLY_OPENPYXL releases,
+        and it only copies what is stored in the worksheets themselves, so chart sheets and tabs with parts other
+        than WRITE_ONLY_PARTS are refused.
+        :return: boolean, False if the destination can not be rebuilt
         """
-        self.execution_time = self.end_time - self.start_time
+        if WorkSheetParser is None or not openpyxl_version.startswith(WRITE_ONLY_OPENPYXL):
+            self.error('--write-only needs openpyxl {}x, found {}'.format(' or '.join(WRITE_ONLY_OPENPYXL),
+                                                                          openpyxl_version))
+            return False
 
-        print('\n')
-        self.message('**[OPERATION COMPLETE]**********************************************************************')
-        if self.arg_data:
-            self.message(' Execution Time: {} ms'.format(self.execution_time))
-            self.message('********************************************************************************************')
-        else:
-            self.message('   Cell Updates: {}'.format(self.cells_updated))
-            self.message(' Cell Additions: {}'.format(self.rows_appended))
-            self.message('         Errors: {}'.format(self.errors))
-            self.message('       Warnings: {}'.format(self.warnings))
-            self.message(' Execution Time: {} ms'.format(self.execution_time))
-            self.message('********************************************************************************************')
+        try:
+            wb = load_workbook(self.fn_destination, read_only=True)
+        except Exception as e:
+            self.error(str(e))
+            return False
 
-    def start_timer(self):
+        supported = True
+        try:
+            for cs in wb.chartsheets:
+                self.error('[{}] is a chart sheet, --write-only can not copy it'.format(cs.title.upper()))
+                supported = False
+            for ws in wb.worksheets:
+                parts = {rel.Type.rsplit('/', 1)[-1] for rel in self.worksheet_relationships(ws)} - WRITE_ONLY_PARTS
+                if len(parts) > 0:
+                    self.error('[{}] has parts --write-only can not copy: {}'.format(ws.title.upper(),
+                                                                                    ', '.join(sorted(parts))))
+                    supported = False
+        finally:
+            wb.close()
+        return supported
+
+    def worksheet_relationships(self, ws_source):
         """
-        Start our timer used to determine execution speed.
-        :return: None
+        Read the relationships of a read-only worksheet, which openpyxl does not load in read-only mode. They link
+        the sheet to its other parts such as comments, drawings and the targets of external hyperlinks.
+        :param ws_source: the read-only worksheet
+        :return: RelationshipList
         """
-        self.start_time = datetime.now()
+        self.is_not_used()
+        archive = ws_source.parent._archive
+        rels_path = get_rels_path(ws_source._worksheet_path)
+        if rels_path not in archive.namelist():
+            return RelationshipList()
+        return get_dependents(archive, rels_path)
 
-    def stop_timer(self):
+    def rebuild_destination(self, fn, rebuilt):
         """
-        Stop our timer used to determine execution speed.
-        :return:
+        Write the destination workbook to fn with the write-only writer. Every tab is streamed from the destination
+        file in its original order, the tabs in rebuilt have their changes merged in as their rows go past and the
+        other tabs are copied through as they are, so only one row of cells is held in memory at a time.
+        :param fn: the file to write
+        :param rebuilt: dictionary of destination tab -> list of CellChange
+        :return: None
         """
-        self.end_time = datetime.now()
-
-    def is_not_used(self):
+        wb_source = load_workbook(self.fn_destination, read_only=True)
+        try:
+            wb = Workbook(write_only=True)
+            wb.iso_dates = True
+            wb.epoch = wb_source.epoch
+            wb.defined_names = copy(wb_source.defined_names)
+            wb.properties = wb_source.properties
+            wb.loaded_theme = wb_source.loaded_theme  # theme colours used by the copied styles
+            wb._fonts = IndexedList([wb_source._fonts[0]])  # the default font, used by cells that have no style
+            for ws_source in wb_source.worksheets:
+                start = datetime.now()
+                ws = wb.create_sheet(ws_source.title)
+                ws.sheet_state = ws_source.sheet_state
+                self.stream_worksheet(ws_source, ws, rebuilt.get(ws_source.title))
+
+                if ws.title in rebuilt:
+                    self.add_timing(ws.title, 'format', start)
+                    self.record_peak_memory(ws.title)
+
+            # set the active worksheet so it opens on this tab
+            wb.active = wb['Hypercare Incidents']
+            wb.save(fn)
+        finally:
+            wb_source.close()
+
+    def stream_worksheet(self, ws_source, ws, changes=None):
         """
-        Useful to get rid of the warning messages about 'self' not being used in a method.
-        :return:
+        Copy a read-only worksheet onto a write-only worksheet row by row, keeping its values, cell styles, column
+        widths, row heights, views, merged cells, conditional formatting, hyperlinks and protection, and write a
+        tab's changes as it goes. Parts stored outside the sheet are checked for by write_only_supported.
+        The rows are read with openpyxl's own sheet parser as the read-only worksheet does not expose the layout.
+        Rows are written in order, so the heights of empty rows below the last row with cells are not kept.
+        :param ws_source: the read-only destination worksheet
+        :param ws: the write-only worksheet to fill
+        :param changes: list of CellChange for the tab, None to copy the tab unchanged
+        :return: None
         """
-        pass
-
-    def parse_args(self):
+        wb_source = ws_source.parent
+        styles = {}  # source style id -> style of the copied cells
+        changed = {}  # row -> changes to existing rows
+        new_rows = {}  # key -> {column: value} for keys that are not in the destination, in the order found
+        for change in changes or []:
+            if change.kind == 'new':
+                new_rows.setdefault(change.key, {1: change.key})[change.col] = change.value
+            else:
+                changed.setdefault(change.row, []).append(change)
+
+        with wb_source._archive.open(ws_source._worksheet_path) as src:
+            parser = WorkSheetParser(src, ws_source._shared_strings, epoch=wb_source.epoch,
+                                     date_formats=wb_source._date_formats,
+                                     timedelta_formats=wb_source._timedelta_formats)
+            header = ()
+            layout = False
+            last_row = 0
+            for idx, cells in parser.parse():
+                if not layout:  # the sheet layout comes before the rows and has to be set before the first one
+                    self.copy_sheet_layout(parser, ws, ('sheet_properties', 'views', 'sheet_format'))
+                    for letter, dimension in parser.column_dimensions.items():
+                        dimension.pop('style', None)  # style ids belong to the source workbook
+                        ws.column_dimensions[letter] = ColumnDimension(ws, **dimension)
+                    layout = True
+
+                dimension = parser.row_dimensions.get(str(idx))
+                if dimension is not None:
+                    dimension.pop('s', None)  # style ids belong to the source workbook
+                    ws.row_dimensions[idx] = RowDimension(ws, **dimension)
+                if not cells:  # rows without cells are only written when a later row has cells
+                    continue
+
+                for x in range(last_row + 1, idx):  # keep row numbers when the source skips empty rows
+                    ws.append(())
+
+                row = [None] * cells[-1]['column']
+                for cell in cells:
+                    row[cell['column'] - 1] = self.copy_cell(ws_source, ws, cell, styles)
+
+                for change in changed.pop(idx, ()):
+                    row.extend([None] * (change.col - len(row)))
+                    this = row[change.col - 1]
+                    if this is None:
+                        this = row[change.col - 1] = WriteOnlyCell(ws)
+
+                    if change.kind == 'reset':
+                        self.format_cell_reset(this)
+                    else:
+                        self.format_cell_updated(this, change.value)
+
+                if idx == 1:
+                    header = [None if this is None else this.value for this in row]
+                ws.append(row)
+
+                for x in range(last_row + 1, idx + 1):  # written, so their heights are no longer needed
+                    ws.row_dimensions.pop(x, None)
+                    parser.row_dimensions.pop(str(x), None)
+                last_row = idx
+
+            if not layout:
+                self.copy_sheet_layout(parser, ws, ('sheet_properties', 'views', 'sheet_format'))
+
+        for key, values in new_rows.items():
+            row = [None] * max(values)
+            for col, value in values.items():
+                row[col - 1] = WriteOnlyCell(ws, value)
+                self.format_cell_updated(row[col - 1])
+            ws.append(row)
+
+        self.copy_sheet_layout(parser, ws, ('protection', 'scenarios', 'auto_filter', 'data_validations',
+                                            'print_options', 'page_margins', 'page_setup', 'HeaderFooter',
+                                            'row_breaks', 'col_breaks'))
+        links = parser.hyperlinks.hyperlink
+        if len(links) > 0:
+            if last_row == 0 and len(new_rows) == 0:  # the sheet writer keeps the links and opens with the first row
+                ws.append(())
+            rels = self.worksheet_relationships(ws_source)
+            for link in links:
+                if link.id is not None:  # external links keep their target with the sheet's relationships
+                    link.target = rels.get(link.id).Target
+                ws._hyperlinks.append(link)
+        if parser.merged_cells is not None:
+            ws.merged_cells = MultiCellRange([cell_range.ref for cell_range in parser.merged_cells.mergeCell])
+        for cf in parser.formatting:
+            for rule in cf.rules:
+                if rule.dxfId is not None:
+                    rule.dxf = wb_source._differential_styles[rule.dxfId]
+                ws.conditional_formatting.add(str(cf.sqref), rule)
+
+        if changes is not None:
+            self.ws_indexes[id(ws)] = WorksheetIndex(ws, {}, self.header_columns(header))
+            self.add_count(ws.title, 'date_rules', self.format_date_columns(ws, self.date_columns.get(ws.title, [])))
+
+    def copy_sheet_layout(self, parser, ws, names):
         """
-        By default without args we will process the files, but we will also give options via
-        command line arguments for things like generating test data.
+        Copy worksheet level settings read by a sheet parser onto a worksheet.
+        :param parser: the WorkSheetParser that read the source worksheet
+        :param ws: the worksheet to copy the settings to
+        :param names: the worksheet attributes to copy, settings the source does not have are left as they are
         :return: None
         """
-        parser = argparse.ArgumentParser()
-        parser.add_argument('-d', '--data', dest='data',
-                            help='Generate requested amount of test data.',
-                            type=int, nargs='+')
-        parser.add_argument('-c', '--check', action='store_true',
-                            dest='check', help='Check files without modifying them.',
-                            default=False)
-        args = parser.parse_args()
-        self.arg_data = args.data
-        self.arg_check = args.check
+        self.is_not_used()
+        for attribute in names:
+            value = getattr(parser, attribute, None)
+            if value is not None:
+                setattr(ws, attribute, value)
 
-        if xc.arg_data:  # did the user request to generate test data?
-            choice = input(Fore.YELLOW + 'This option will ' + Fore.RED +
-                           '*OVERWRITE ALL FILES* ' + Fore.YELLOW + 'you sure (y/n)? ')
-            if choice.upper() == 'Y':
-                self.test_data_row_count = int(self.arg_data[0])
-                xc.generate_test_data()
-            else:
-                xc.arg_data = False
+    def copy_cell(self, ws_source, ws, cell, styles):
+        """
+        Copy a cell read by a sheet parser to a write-only cell. The style each source style id turns into is
+        worked out once per worksheet and copied onto later cells.
+        :param ws_source: the read-only worksheet the cell was read from
+        :param ws: the write-only worksheet the cell is copied to
+        :param cell: dictionary of the cell's row, column, value, data_type and style_id
+        :param styles: dictionary of source style id -> style, updated in place
+        :return: WriteOnlyCell
+        """
+        self.is_not_used()
+        this = WriteOnlyCell(ws)
+        this.value = cell['value']
+        this.data_type = cell['data_type']  # text such as '=x' or '#N/A' would pass for a formula or an error
+
+        style = styles.get(cell['style_id'])
+        if style is None:
+            source = ReadOnlyCell(ws_source, cell['row'], cell['column'], None, style_id=cell['style_id'])
+            this.font = source.font
+            this.fill = source.fill
+            this.border = source.border
+            this.alignment = source.alignment
+            this.protection = source.protection
+            this.number_format = source.number_format
+            styles[cell['style_id']] = copy(this._style)
         else:
-            self.process_dump_files()
+            this._style = copy(style)
 
-    def process_dump_files(self):
+        return this
+
+    def process_dump_files_parallel(self, skipped):
         """
-        Process all the sheets in our workbooks looking for changes.
+        Diff each dump file against its destination tab in a separate worker process, then apply all of the
+        changesets to the destination workbook and save it once. As in a serial run nothing is synced when one of
+        the dump files can not be read.
+        :param skipped: list of dump file names that are unchanged since the last sync
         :return: None
         """
-        if not self.open_workbooks():
+        start = datetime.now()
+        try:  # as in a serial run, only tab titles are needed when exporting or rebuilding the destination
+            self.wb_destination = load_workbook(self.fn_destination,
+                                                read_only=self.arg_export is not None or self.arg_write_only)
+            self.wb_destination.iso_dates = True
+        except Exception as e:
+            self.error(str(e))
             exit()
+        self.add_timing('run', 'load', start)
 
-        self.message('*****************************************************************************')
-        self.message('Only columns that exist in both the dump and destination file will be synced.')
-        self.message('They must also match exactly including spelling and capitalization.')
-        self.message('*****************************************************************************')
-
-        self.wb_destination.active = self.wb_destination['Hypercare Incidents']
-        self.parse_dump_file(self.wb_incident.active, self.wb_destination.active, self.fn_incident)
+        tabs = [(fn_dump, tab) for fn_dump, tab in self.dump_tabs() if fn_dump not in skipped]
 
-        self.wb_destination.active = self.wb_destination['Hypercare Defects']
-        self.parse_dump_file(self.wb_defect.active, self.wb_destination.active, self.fn_defect)
-
-        self.wb_destination.active = self.wb_destination['Hypercare Enhancements']
-        self.parse_dump_file(self.wb_enhancement.active, self.wb_destination.active, self.fn_enhancement)
+        results = {}
+        loaded = True
+        with ProcessPoolExecutor(max_workers=self.arg_jobs) as pool:
+            futures = {}
+            for fn_dump, tab in tabs:
+                previous = None
+                if self.manifest is not None:
+                    previous = {'dumps': {fn_dump: self.manifest['dumps'].get(fn_dump)}}
+                cache = (self.cache.directory, self.cache.max_bytes) if self.cache is not None else None
+                futures[fn_dump] = pool.submit(diff_worker, fn_dump, self.fn_destination, tab, self.date_fields,
+                                               previous, self.arg_engine, cache)
+
+            for fn_dump, tab in tabs:
+                try:
+                    results[fn_dump] = futures[fn_dump].result()
+                except Exception as e:
+                    self.error('[{}] {}'.format(fn_dump.upper(), str(e)))
+                    loaded = False
+
+        if not loaded:  # like a serial run nothing is synced when a dump file can not be read
+            exit()
 
-        self.wb_destination.active = self.wb_destination['ALM Defects']
-        self.parse_dump_file(self.wb_alm.active, self.wb_destination.active, self.fn_alm)
+        def replay(fn_dump, tab):
+            changes, log, fingerprints, timings, counts, date_columns, (hits, misses) = results[fn_dump]
+            for level, value, line_before, group in log:  # replay worker output so our counters match
+                getattr(self, level)(value, line_before, group)
+            self.timings.setdefault(tab, {}).update(timings)
+            self.counts.setdefault(tab, {}).update(counts)
+            self.date_columns[tab] = date_columns
+            if self.cache is not None:
+                self.add_count('run', 'cache_hits', hits)
+                self.add_count('run', 'cache_misses', misses)
+            if fingerprints is not None:
+                self.manifest_updates[fn_dump] = fingerprints
+            return None, changes
+
+        self.sync_dump_tabs(skipped, replay)
 
     def parse_dump_file(self, ws_dump, ws_dest, fn_dump):
         """
@@ -291,38 +2123,171 @@ class ExcelPY:
         :param fn_dump: the name of the dump file being parsed
         :return: None
         """
+        changes = self.diff_dump_file(ws_dump, ws_dest, fn_dump)
+        if changes is None:
+            return
+
+        self.apply_changes(ws_dest, fn_dump, changes)
+
+    def diff_dump_file(self, ws_dump, ws_dest, fn_dump, changes=None):
+        """
+        Compare a dump worksheet against its destination worksheet without modifying either one.
+        :param ws_dump: one of our dump workbooks that we will use as data input
+        :param ws_dest: the worksheet in our output file that should be compared
+        :param fn_dump: the name of the dump file being parsed
+        :param changes: list, or ChangesetWriter, each CellChange is appended to as soon as it is found
+        :return: changes, or None if the sheets can not be synced
+        """
         self.message('BEGIN: [{}] -> [{}]:'.format(fn_dump.upper(), self.fn_destination.upper()), True)
+        tab = ws_dest.title
+        start = datetime.now()
         dump_headers = {}  # column headers from our dump file
         dest_headers = {}  # column headers from our destination file
-        comm_headers = {}  # column headers common to both files
 
-        rows_updated = 0
-        rows_appended = 0
+        # each sheet is read once, top to bottom, starting with the header row
+        dump_rows = ws_dump.iter_rows(values_only=True)
+        dest_rows = ws_dest.iter_rows(values_only=True)
+        dump_header = next(dump_rows, ())
+        dest_header = next(dest_rows, ())
 
         # get a list of dump column headers so we can use them for searching
-        for x, cell in enumerate(ws_dump[1]):
-            dump_headers[cell.value] = x + 1
+        for x, value in enumerate(dump_header):
+            dump_headers[value] = x + 1
 
         # get a list of destination column headers so we can use them for searching
-        for x, cell in enumerate(ws_dest[1]):
-            dest_headers[cell.value] = x + 1
+        for x, value in enumerate(dest_header):
+            dest_headers[value] = x + 1
 
         # get a list of column headers from both sheets using column locations from destination
-        for key1, val1 in dest_headers.items():
-            for key2, val2 in dump_headers.items():
-                if key1 == key2:
-                    comm_headers[key1] = val1
-                    break
-
-        # now parse our dump file to arg_check for duplicate 'keys'
-        if self.worksheet_has_duplicate_keys(ws_dump, fn_dump):
-            return
+        comm_headers = {key: col for key, col in dest_headers.items() if key in dump_headers}
+        headers = list(comm_headers)
+        self.add_timing(tab, 'headers', start)
+
+        if self.arg_engine == 'sqlite' and self.manifest is None:  # incremental runs stay row by row
+            return self.diff_staged(ws_dump, ws_dest, fn_dump, dump_rows, dest_rows, dump_header, dest_header,
+                                    comm_headers, changes)
+
+        # the destination is read first so the dump can be streamed through the diff
+        start = datetime.now()
+        index = self.ws_indexes.get(id(ws_dest)) if self.arg_watch is not None else None
+        kept = index is not None and index.ws is ws_dest
+        if kept:  # watch mode keeps the destination loaded, its index stays valid as only we write to it
+            dest = IndexedRecords(index, headers)
+        else:
+            dest, dest_keys, duplicates = self.scan_worksheet(dest_rows, dest_header, headers)
+            if len(duplicates) > 0:
+                # the dump is still checked first, only its keys are needed for that
+                _, _, dump_duplicates = self.scan_worksheet(dump_rows, dump_header, [])
+                if not self.report_duplicate_keys(dump_duplicates, ws_dump, fn_dump):
+                    self.report_duplicate_keys(duplicates, ws_dest, self.fn_destination)
+                self.manifest_updates.pop(fn_dump, None)
+                return None
+
+            # the destination scan already found every key, so the index does not need its own pass
+            index = WorksheetIndex(ws_dest, dest_keys, self.header_columns(dest_header))
+            self.ws_indexes[id(ws_dest)] = index
+        self.add_timing(tab, 'dictionary', start)
+
+        if self.arg_engine == 'numpy' and self.manifest is None:  # incremental runs stay row by row
+            start = datetime.now()
+            dump, _, duplicates = self.scan_worksheet(dump_rows, dump_header, headers)
+            if kept:
+                dest = dest.store(dump.positions)
+            self.add_timing(tab, 'dictionary', start)
+
+            if self.report_duplicate_keys(duplicates, ws_dump, fn_dump):
+                return None
+            self.warn_header_differences(fn_dump, dump_headers, dest_headers)
+
+            start = datetime.now()
+            changes = self.diff_columns(dump, dest, index, comm_headers, tab, changes)
+            self.add_timing(tab, 'diff', start)
+            self.add_count(tab, 'cells_compared', len(changes))
+            self.record_peak_memory(tab)
+            return changes
+
+        missing = (0, (None,) * len(headers))  # stands in for keys that are not in the destination
+        start = datetime.now()
+        changes = [] if changes is None else changes
+        mark = changes.mark() if isinstance(changes, ChangesetWriter) else len(changes)
+        new_rows = {}  # see cell_change
+
+        # when running incrementally rows are skipped if neither side changed since the last sync
+        previous = None
+        fingerprints = None
+        if self.manifest is not None:
+            previous = self.manifest['dumps'].get(fn_dump)
+            touched = set(previous['touched']) if previous is not None else set()
+            fingerprints = {'touched': [], 'dump_rows': {}, 'dest_rows': {}}
+            self.manifest_updates[fn_dump] = fingerprints
+
+        # the dump is checked for duplicate keys as it is streamed through the diff, what was found is thrown away
+        # if it has any
+        columns = self.header_columns(dump_header)
+        duplicates = {}
+        dump = self.scan_rows(dump_rows, tuple(columns.get(d) for d in headers), {}, duplicates)
+
+        # the first few dump rows are used to find the date columns for the past-date highlighting rules
+        sample = list(islice(dump, self.date_sample_size))
+        date_columns = self.infer_date_columns(headers, [dump_values for key, row, dump_values in sample])
+        self.date_columns[tab] = [d for d in headers if d in date_columns]
+
+        for key, _, dump_values in chain(sample, dump):
+            if len(duplicates) > 0:  # the dump can not be synced, keep reading only to report its duplicates
+                continue
+
+            _, dest_values = dest.get(key, missing)
+
+            if fingerprints is not None:
+                dump_fp = self.row_fingerprint(tuple((d, value) for d, value in zip(headers, dump_values)
+                                                     if value is not None))
+                dest_fp = self.row_fingerprint(tuple(zip(headers, dest_values)))
+                fingerprints['dump_rows'][repr(key)] = dump_fp
+                fingerprints['dest_rows'][repr(key)] = self.row_fingerprint(
+                    tuple((d, value if value is not None else old)
+                          for d, value, old in zip(headers, dump_values, dest_values)))
+
+                if previous is not None and repr(key) not in touched and \
+                        previous['dump_rows'].get(repr(key)) == dump_fp and \
+                        previous['dest_rows'].get(repr(key)) == dest_fp:
+                    continue
+
+            dest_row = index.rows.get(key)
+            row_touched = False
+            for y, d in enumerate(headers):
+                value = dump_values[y]
+                if value is None:
+                    continue
+
+                change = cell_change(key, d, value, dest_values[y], dest_row, dest.cols[y], new_rows)
+                changes.append(change)
+                row_touched = row_touched or change.kind != 'reset'
+
+            if fingerprints is not None and row_touched:
+                fingerprints['touched'].append(repr(key))
+        self.add_timing(tab, 'diff', start)
+
+        if self.report_duplicate_keys(duplicates, ws_dump, fn_dump):
+            if isinstance(changes, ChangesetWriter):
+                changes.rollback(mark)
+            else:
+                del changes[mark:]
+            self.manifest_updates.pop(fn_dump, None)
+            return None
 
-        # now parse our destination file to arg_check for duplicate 'keys'
-        if self.worksheet_has_duplicate_keys(ws_dest, self.fn_destination):
-            return
+        self.warn_header_differences(fn_dump, dump_headers, dest_headers)
+        self.add_count(tab, 'cells_compared', len(changes))
+        self.record_peak_memory(tab)
+        return changes
 
-        # let's case-sensitive arg_check our column headers for differences if any.
+    def warn_header_differences(self, fn_dump, dump_headers, dest_headers):
+        """
+        Case-sensitive check of our column headers for differences if any.
+        :param fn_dump: the name of the dump file being parsed
+        :param dump_headers: column headers from our dump file
+        :param dest_headers: column headers from our destination file
+        :return: None
+        """
         s1 = set(dump_headers)
         s2 = set(dest_headers)
 
@@ -332,51 +2297,256 @@ class ExcelPY:
             if len(s1_diff) > 0:
                 self.warning('{} exclusively contains the following columns: '.format(fn_dump.upper()))
                 for x, item in enumerate(s1_diff):
-                    self.warning('\t{}. \'{}\''.format(x + 1, str(item)))
+                    self.warning('\t{}. \'{}\''.format(x + 1, str(item)), group=fn_dump)
             if len(s2_diff) > 0:
                 self.warning('{} exclusively contains the following columns: '.format(self.fn_destination.upper()))
                 for x, item in enumerate(s2_diff):
-                    self.warning('\t{}. \'{}\''.format(x + 1, str(item)))
-
-        dump_dict = self.parse_worksheet_into_dictionary(ws_dump, comm_headers)
-        dest_dict = self.parse_worksheet_into_dictionary(ws_dest, comm_headers)
-        comb_dict = {**dest_dict, **dump_dict}
-
-        for a, b in enumerate(comb_dict):  # enumerate dictionary key
-            key = b
-            dump_row = dump_dict[key]
-            for c, d in enumerate(dump_row):  # enumerate dictionary rows
-                value = dump_row[d]['value']
-                result = self.get_cell_details(ws_dest, key, d)
-                if result['cell_found']:  # does this key exist in destination
-                    this = ws_dest.cell(row=dest_dict[b][d]['row'], column=dest_dict[b][d]['col'])
-                    if this.value != value:  # update destination cell
-                        self.cells_updated += 1
-                        self.format_cell_updated(this, value)
-                    else:
-                        self.format_cell_reset(this)
-                else:  # key is not present so we are creating a new row
-                    if result['key_found']:  # we need to add the remaining values for columns
-                        this = ws_dest.cell(row=result['row'], column=result['col'])
-                    else:  # append a new row and add the primary key
-                        this = ws_dest.cell(row=ws_dest.max_row + 1, column=comm_headers[d])
+                    self.warning('\t{}. \'{}\''.format(x + 1, str(item)), group=self.fn_destination)
 
-                    self.format_cell_updated(this, value)
-                    self.rows_appended += 1
+    def diff_staged(self, ws_dump, ws_dest, fn_dump, dump_rows, dest_rows, dump_header, dest_header, comm_headers,
+                    changes=None):
+        """
+        Version of the diff in diff_dump_file for tabs that do not fit in memory. Dump and destination rows are
+        streamed into a temporary SQLite database indexed on primary key, then duplicate keys are found with
+        GROUP BY and each dump row is joined to its destination row, so neither sheet is held in memory.
+        :param ws_dump: one of our dump workbooks that we will use as data input
+        :param ws_dest: the worksheet in our output file that should be compared
+        :param fn_dump: the name of the dump file being parsed
+        :param dump_rows: iterator over the dump's value rows, positioned after the header row
+        :param dest_rows: iterator over the destination's value rows, positioned after the header row
+        :param dump_header: the dump's header row
+        :param dest_header: the destination's header row
+        :param comm_headers: column headers common to both files
+        :param changes: list, or ChangesetWriter, the changes are appended to
+        :return: changes, or None if the sheets can not be synced
+        """
+        tab = ws_dest.title
+        headers = list(comm_headers)
+        handle, fn_stage = mkstemp(suffix='.sqlite')
+        close(handle)
+        db = sqlite3.connect(fn_stage)
+        try:
+            db.execute('PRAGMA journal_mode = OFF')  # the database is thrown away afterwards
+            db.execute('PRAGMA synchronous = OFF')
+
+            start = datetime.now()
+            dest_cols = self.stage_worksheet(db, 'dest', dest_rows, dest_header, headers)
+            self.stage_worksheet(db, 'dump', dump_rows, dump_header, headers)
+            self.add_timing(tab, 'dictionary', start)
+
+            start = datetime.now()
+            if self.staged_duplicate_keys(db, 'dump', ws_dump, fn_dump) or \
+                    self.staged_duplicate_keys(db, 'dest', ws_dest, self.fn_destination):
+                self.manifest_updates.pop(fn_dump, None)
+                return None
+            self.add_timing(tab, 'duplicates', start)
+
+            self.warn_header_differences(fn_dump, dump_header, dest_header)
+
+            start = datetime.now()
+            columns = ', '.join('v{}'.format(y) for y in range(len(headers)))
+            sample = [tuple(python_value(value) for value in row) for row in
+                      db.execute('SELECT {} FROM dump WHERE filled ORDER BY rowid LIMIT ?'.format(columns),
+                                 (self.date_sample_size,))]
+            date_columns = self.infer_date_columns(headers, sample)
+            self.date_columns[tab] = [d for d in headers if d in date_columns]
+
+            changes = [] if changes is None else changes
+            new_rows = {}  # see cell_change
+            width = len(headers)
+            query = 'SELECT d.key, {}, t.row, {} FROM dump d LEFT JOIN dest t ON t.key IS d.key ' \
+                    'WHERE d.filled ORDER BY d.rowid'.format(', '.join('d.v{}'.format(y) for y in range(width)),
+                                                            ', '.join('t.v{}'.format(y) for y in range(width)))
+            for record in db.execute(query):
+                key = python_value(record[0])
+                dest_row = record[width + 1]
+                for y, d in enumerate(headers):
+                    value = python_value(record[y + 1])
+                    if value is not None:
+                        changes.append(cell_change(key, d, value, python_value(record[width + 2 + y]), dest_row,
+                                                   dest_cols[y], new_rows))
+        except Exception as e:
+            self.error(str(e))
+            return None
+        finally:
+            db.close()
+            remove(fn_stage)
+
+        self.add_timing(tab, 'diff', start)
+        self.add_count(tab, 'cells_compared', len(changes))
+        self.record_peak_memory(tab)
+        return changes
+
+    def stage_worksheet(self, db, table, rows, header, headers):
+        """
+        Stream every row of a worksheet into a table of the staging database: its primary key, row number, whether
+        it has anything in the headers' columns and one value column per header.
+        :param db: the staging database
+        :param table: name of the table to create
+        :param rows: iterator over the worksheet's value rows, positioned after the header row
+        :param header: the worksheet's header row
+        :param headers: list of common headers
+        :return: tuple of the column of each header
+        """
+        columns = self.header_columns(header)
+        cols = tuple(columns.get(d) for d in headers)
+        db.execute('CREATE TABLE {} (key, row INTEGER, filled INTEGER, {})'.format(
+            table, ', '.join('v{}'.format(y) for y in range(len(headers)))))
+
+        def records():
+            for x, row in enumerate(rows):
+                values = [row[col - 1] if col is not None and col <= len(row) else None for col in cols]
+                yield ([sqlite_value(row[0] if len(row) > 0 else None), x + 2, values.count(None) < len(values)] +
+                       [sqlite_value(value) for value in values])
+
+        db.executemany('INSERT INTO {} VALUES ({})'.format(table, ', '.join('?' * (len(headers) + 3))), records())
+        db.execute('CREATE INDEX {0}_key ON {0} (key)'.format(table))
+        return cols
+
+    def staged_duplicate_keys(self, db, table, ws, fn):
+        """
+        Same duplicate key check as scan_worksheet on a staged worksheet.
+        :param db: the staging database
+        :param table: the table the worksheet was staged into
+        :param ws: the worksheet that was staged
+        :param fn: the file name associated with ws
+        :return: boolean
+        """
+        duplicates = {}
+        for key, rows in db.execute('SELECT key, GROUP_CONCAT(row) FROM {} GROUP BY key HAVING COUNT(*) > 1 '
+                                    'ORDER BY MIN(rowid) LIMIT ?'.format(table), (self.duplicate_limit,)):
+            duplicates[python_value(key)] = [int(row) for row in rows.split(',')]
+
+        return self.report_duplicate_keys(duplicates, ws, fn)
+
+    def diff_columns(self, dump_records, dest_records, index, comm_headers, tab, changes=None):
+        """
+        Columnar version of the diff loop in diff_dump_file. Dump and destination values are loaded into NumPy
+        arrays and the destination is aligned to the dump by primary key with whole column operations, then the
+        filled dump cells are handed to cell_change in dump row order.
+        :param dump_records: RecordStore of the dump worksheet
+        :param dest_records: RecordStore of the destination worksheet
+        :param index: WorksheetIndex of the destination worksheet
+        :param comm_headers: column headers common to both files
+        :param tab: name of the destination tab
+        :param changes: list, or ChangesetWriter, the changes are appended to
+        :return: changes
+        """
+        changes = [] if changes is None else changes
+        headers = list(comm_headers)
+        keys = list(dump_records.positions)
+        date_columns = self.infer_date_columns(headers, dump_records.values[:self.date_sample_size])
+        self.date_columns[tab] = [d for d in headers if d in date_columns]
+        if len(keys) == 0:
+            return changes
+
+        dump = self.record_array(dump_records)
+        dest_values = np.vstack([self.record_array(dest_records),
+                                 np.full((1, len(headers)), None, dtype=object)])  # empty last row
+
+        # align the destination to the dump by primary key, missing keys pick up the empty last row
+        position = np.array([dest_records.positions.get(key, -1) for key in keys])
+        dest = dest_values[position]
+        present = np.not_equal(dump, None)
+
+        dest_cols = [index.cols.get(d) for d in headers]
+        new_rows = {}  # see cell_change
+        rows = [index.rows.get(key) for key in keys]
+        values = dump.tolist()
+        old_values = dest.tolist()
+
+        for x, y in zip(*(axis.tolist() for axis in np.nonzero(present))):
+            changes.append(cell_change(keys[x], headers[y], values[x][y], old_values[x][y], rows[x], dest_cols[y],
+                                       new_rows))
+
+        return changes
+
+    def record_array(self, records):
+        """
+        Copy the values of a RecordStore into a NumPy array.
+        :param records: the RecordStore
+        :return: keys x headers object array
+        """
+        self.is_not_used()
+        values = np.empty((len(records), len(records.headers)), dtype=object)
+        if len(records) > 0:
+            values[:] = records.values
 
-                if self.is_date(this.value):
-                    if self.format_date(this.value) < self.format_date(datetime.now()):
-                        self.format_cell_date_passed(this)
+        return values
 
-        # save our workbook with all changes
+    def apply_changes(self, ws_dest, fn_dump, changes):
+        """
+        Write a changeset produced by diff_dump_file to the destination worksheet and update our counters.
+        :param ws_dest: the worksheet in our output file the changes belong to
+        :param fn_dump: the name of the dump file the changes came from
+        :param changes: list of CellChange
+        :return: None
+        """
+        start = datetime.now()
+        rows_updated = 0
+        rows_appended = 0
+        new_rows = {}  # key -> {column: value} for keys that are not in the destination, in the order found
+
+        for change in changes:
+            if change.kind == 'new':  # collected and appended as whole rows once the existing rows are done
+                rows_appended += 1
+                new_rows.setdefault(change.key, {1: change.key})[change.col] = change.value
+                continue
+
+            this = ws_dest.cell(row=change.row, column=change.col)
+
+            if change.kind == 'update':  # update destination cell
+                rows_updated += 1
+                self.format_cell_updated(this, change.value)
+            elif change.kind == 'reset':
+                self.format_cell_reset(this)
+            else:  # append
+                rows_appended += 1
+                self.format_cell_updated(this, change.value)
+                self.worksheet_index(ws_dest).add_cell(this)
+
+        self.append_rows(ws_dest, new_rows)
+
+        self.add_count(ws_dest.title, 'date_rules', self.format_date_columns(ws_dest,
+                                                                             self.date_columns.get(ws_dest.title, [])))
+        cells_written = rows_updated + rows_appended
         self.cells_updated += rows_updated
         self.rows_appended += rows_appended
+        self.add_timing(ws_dest.title, 'format', start)
+        self.add_count(ws_dest.title, 'cells_written', cells_written)
+        self.add_count(ws_dest.title, 'style_assignments', len(changes))
+        self.record_peak_memory(ws_dest.title)
         self.message('END: [{}]  [Updates: {}] [Additions: {}]'.format(fn_dump.upper(), rows_updated, rows_appended))
 
-        # set the active worksheet so it opens on this tab
-        if not self.arg_check:
-            self.wb_destination.active = self.wb_destination['Hypercare Incidents']
-            self.wb_destination.save(self.fn_destination)
+    def append_rows(self, ws, rows):
+        """
+        Append one row per new key below the last row of a worksheet in a single block and format the written
+        cells as updated.
+        :param ws: the destination worksheet
+        :param rows: dictionary of primary key -> {column: value}, the key is written to the first column
+        :return: None
+        """
+        index = self.worksheet_index(ws)
+        last_row = ws.max_row  # worked out once, openpyxl scans every cell to find it
+
+        for x, (key, values) in enumerate(rows.items()):
+            row = last_row + x + 1
+            ws.append(values)
+            for col in values:
+                self.format_cell_updated(ws.cell(row=row, column=col))
+            index.rows.setdefault(key, row)
+
+    def worksheet_index(self, ws):
+        """
+        Get the key/header index for a worksheet, building it the first time the sheet is seen.
+        :param ws: the worksheet to index
+        :return: WorksheetIndex
+        """
+        index = self.ws_indexes.get(id(ws))
+        if index is None or index.ws is not ws:
+            index = WorksheetIndex(ws)
+            self.ws_indexes[id(ws)] = index
+        return index
 
     def get_cell_details(self, ws, primary_key, header_name):
         """
@@ -389,86 +2559,93 @@ class ExcelPY:
                  ['grid_found'] - we matched primary key and column header
                  ['cell_found'] - we used row, col grid and that cell's value was not None
         """
-        results = {'cell_found': False, 'key_found': False, 'grid_found': False}
-
         try:
-            for x in range(2, ws.max_row + 1):
-                if primary_key == ws.cell(row=x, column=1).value:  # true if we find our primary key
-                    results['key_found'] = True
-                    for y in range(1, ws.max_column + 1):
-                        if header_name == ws.cell(row=1, column=y).value:  # true if we found our column header
-                            results['grid_found'] = True
-                            results['row'] = x
-                            results['col'] = y
-                            if ws.cell(row=x, column=y).value is not None:  # true if there is a value at grid location
-                                results['value'] = ws.cell(row=x, column=y).value
-                                results['cell_found'] = True
-                            return results
+            return self.worksheet_index(ws).get_cell_details(primary_key, header_name)
         except Exception as e:
             self.error(str(e))
 
-        return results
+        return {'cell_found': False, 'key_found': False, 'grid_found': False}
 
-    def parse_worksheet_into_dictionary(self, ws, headers):
+    def scan_worksheet(self, rows, header, headers):
         """
-        To avoid using loops all over the place we load our worksheets into dictionaries and run all logic from
-        there. This gives us the useful information in our return value.
-        :param ws: worksheet to parse
-        :param headers: list of common headers in order to match destination columns
-        :return: ['value'] - the value in each cell
-                 ['row'] - the row for each cell
-                 ['col'] - the column for each cell
+        Validate and load a worksheet in a single pass. Duplicate keys are collected with their row numbers and
+        the scan stops once duplicate_limit of them have been found, as the sheet can not be synced anyway.
+        :param rows: iterator over the worksheet's value rows, positioned after the header row
+        :param header: the worksheet's header row
+        :param headers: list of common headers to keep the values of
+        :return: (RecordStore of the headers' values, primary key -> first row, duplicate key -> rows)
         """
-        self.is_not_used()
-        result = {}
-
-        try:
-            for x in range(2, ws.max_row + 1):  # enumerate rows
-                data = {}
-                pkey = ws.cell(row=x, column=1).value
-                for key, value in headers.items():
-                    buffer = self.get_cell_details(ws, pkey, key)
-                    if buffer['cell_found']:
-                        value = {'value': buffer['value'], 'row': buffer['row'], 'col': buffer['col']}
-                        data[key] = value
-                        result[pkey] = data
+        columns = self.header_columns(header)
+        cols = tuple(columns.get(d) for d in headers)
+        records = RecordStore(headers, cols)
+        keys = {}  # primary key -> first row containing that key
+        duplicates = {}
 
-        except Exception as e:
-            self.error(str(e))
+        for key, row, values in self.scan_rows(rows, cols, keys, duplicates):
+            records.add(key, row, values)
 
-        return result
+        return records, keys, duplicates
 
-    def worksheet_has_duplicate_keys(self, ws, fn):
+    def scan_rows(self, rows, cols, keys, duplicates):
         """
-        Parse a worksheet (primarily useful for dump files) and check for duplicate primary keys.
-        :param ws: the works sheet to parse
-        :param fn: the fle name associated with ws
-        :return: boolean
+        Stream the rows of a worksheet, collecting its keys and duplicate keys on the way. Only the first row of each
+        key is handed on, and reading stops once duplicate_limit duplicate keys have been found.
+        :param rows: iterator over the worksheet's value rows, positioned after the header row
+        :param cols: tuple of the column of each header to keep, None for headers the sheet does not have
+        :param keys: dictionary of primary key -> first row, filled in as the rows are read
+        :param duplicates: dictionary of duplicate key -> rows, filled in as the rows are read
+        :return: generator of (primary key, row, tuple of values in header order), rows with nothing in these
+                 columns are left out
+        """
+        for x, row in enumerate(rows):
+            key = row[0] if len(row) > 0 else None
+            first = keys.setdefault(key, x + 2)
+            if first != x + 2:
+                duplicates.setdefault(key, [first]).append(x + 2)
+                if len(duplicates) >= self.duplicate_limit:
+                    return
+                continue
+
+            values = tuple(row[col - 1] if col is not None and col <= len(row) else None for col in cols)
+            if values.count(None) < len(values):
+                yield key, x + 2, values
+
+    def header_columns(self, header):
+        """
+        Find the column of each header in a header row.
+        :param header: the header row values
+        :return: dictionary of header -> first column containing that header
         """
         self.is_not_used()
-        results = {}
-
-        for x in ws.iter_rows(2, ws.max_row, values_only=True):  # enumerate our worksheet keys
-            key = x[0]
-            if key in results:  # see if key is already in the dictionary
-                results[key] = results[key] + 1  # if yes then increment found counter
-            else:
-                results[key] = 1  # key wasn't in the dictionary so add it now
+        columns = {}
+        for x, value in enumerate(header):
+            columns.setdefault(value, x + 1)
 
-        for key, value in list(results.items()):  # enumerate our keys
-            if results[key] == 1:  # if value > 1 then it is a duplicate key
-                del results[key]  # not a duplicate so remove from dictionary
-            else:
-                results[key] = 'occurrences: ' + str(value)
+        return columns
 
-        if len(results.keys()) > 0:
-            self.error(
-                '[{}] ({}) contains the following duplicate keys in the first column:'.format(fn.upper(), ws.title))
-            self.error(str(results))
-            return True
-        else:
+    def report_duplicate_keys(self, duplicates, ws, fn):
+        """
+        Report the duplicate keys found in a worksheet.
+        :param duplicates: dictionary of duplicate key -> rows containing it
+        :param ws: the worksheet the keys are in
+        :param fn: the file name associated with ws
+        :return: boolean, True if there are duplicates
+        """
+        if len(duplicates) == 0:
             return False
 
+        self.error('[{}] ({}) contains the following duplicate keys in the first column:'.format(fn.upper(), ws.title))
+        results = {}
+        for key, rows in duplicates.items():
+            results[key] = 'rows: ' + ', '.join(str(row) for row in rows[:self.duplicate_limit])
+            if len(rows) > self.duplicate_limit:  # a key can repeat on every row, e.g. empty rows
+                results[key] += ' and {} more'.format(len(rows) - self.duplicate_limit)
+        self.error(str(results))
+        if len(duplicates) >= self.duplicate_limit:
+            self.error('[{}] ({}) stopped looking after {} duplicate keys'.format(fn.upper(), ws.title,
+                                                                                 self.duplicate_limit))
+        return True
+
     def format_cell_updated(self, cell, value=None):
         """
         Format a cell to identify it as updated
@@ -476,12 +2653,10 @@ class ExcelPY:
         :param value: an optional value to set the cell to
         :return: None
         """
-        self.is_not_used()
         if value is not None:
             cell.value = value
 
-        cell.fill = PatternFill(start_color='7fffd4', end_color='7fffd4', fill_type='solid')
-        cell.font = Font(name='Ubuntu', size=11, color='555555', bold=False, italic=False)
+        self.style_cell(cell, FILL_UPDATED, FONT_UPDATED)
 
     def format_cell_reset(self, cell, value=None):
         """
@@ -490,109 +2665,195 @@ class ExcelPY:
         :param value: an optional value to set the cell to
         :return: None
         """
-        self.is_not_used()
         if value is not None:
             cell.value = value
 
-        cell.fill = PatternFill(fill_type='none')
-        cell.font = Font(name='Ubuntu', size=11, color='2e2e2e', bold=False, italic=False)
+        self.style_cell(cell, FILL_RESET, FONT_RESET)
 
-    def format_cell_date_passed(self, cell, value=None):
+    def format_date_columns(self, ws, headers):
+        """
+        Install a conditional formatting rule on each date column so Excel highlights dates before today itself,
+        which keeps the highlighting correct between syncs. Dates may be real Excel dates or text starting with an
+        ISO formatted date. Columns that already have the rule are left alone.
+        :param ws: the destination worksheet
+        :param headers: the date column headers
+        :return: number of rules installed
         """
-        Reset a cell to indicate the date is before today
+        index = self.worksheet_index(ws)
+        existing = set()  # (range, formula) of the rules already on the sheet
+        for cf in ws.conditional_formatting:
+            for rule in cf.rules:
+                existing.add((str(cf.sqref), tuple(rule.formula)))
+
+        installed = 0
+        for header in headers:
+            col = index.cols.get(header)
+            if col is None:
+                continue
+
+            letter = get_column_letter(col)
+            cells = '{0}2:{0}1048576'.format(letter)  # the whole column below the header, appended rows included
+            formula = ['AND({0}2<>"",IFERROR(DATEVALUE(LEFT({0}2,10)),{0}2)<TODAY())'.format(letter)]
+            if (cells, tuple(formula)) in existing:
+                continue
+
+            ws.conditional_formatting.add(cells, FormulaRule(formula=formula, fill=FILL_DATE_PASSED,
+                                                             font=FONT_DATE_PASSED))
+            installed += 1
+
+        return installed
+
+    def style_cell(self, cell, fill, font):
+        """
+        Apply a fill and font to a cell. openpyxl hashes the style objects on every assignment, so the style each
+        starting style turns into is remembered per workbook and copied onto later cells instead.
         :param cell: the cell to format
-        :param value: an optional value to set the cell to
+        :param fill: the PatternFill to apply
+        :param font: the Font to apply
         :return: None
         """
-        self.is_not_used()
-        if value is not None:
-            cell.value = value
-
-        cell.fill = PatternFill(start_color='b22222', end_color='b22222', fill_type='solid')
-        cell.font = Font(name='Ubuntu', size=11, color='ffffff', bold=False, italic=False)
+        key = (id(cell.parent.parent), id(fill), id(font), tuple(cell._style) if cell._style is not None else None)
+        style = self.style_cache.get(key)
+        if style is None:
+            cell.fill = fill
+            cell.font = font
+            self.style_cache[key] = copy(cell._style)
+        else:
+            cell._style = copy(style)
 
-    def days_between(self, d1, d2):
+    def infer_date_columns(self, headers, sample):
         """
-        Calculate the number of days between two dates
-        :param d1: the first date
-        :param d2: the second date
-        :return: number of days between dates
+        Decide once per sync which columns hold dates. A column is a date column if its header is listed in
+        date_fields, or if every sampled value in it can be read as a date.
+        :param headers: the common column headers
+        :param sample: list of value tuples in header order read from the start of the dump
+        :return: set of column headers
         """
-        self.is_not_used()
-        try:
-            d1 = self.format_date(d1)
-            d2 = self.format_date(d2)
-            d1 = datetime.strptime(d1, '%Y-%m-%d')
-            d2 = datetime.strptime(d2, '%Y-%m-%d')
-            return abs((d2 - d1).days)
-        except Exception as e:
-            self.error(str(e))
+        date_columns = set()
 
-    def format_date(self, date_val):
-        """
-        Generally keep our dates in the format that we want.
-        :param date_val: the date value to format
-        :return: a newly formatted date value
-        """
-        try:
-            if type(date_val) is not datetime:
-                d = date.fromisoformat(date_val[0:10])
-            else:
-                d = date_val
-            return d.strftime('%Y-%m-%d')
-        except Exception as e:
-            self.error((str(e)))
+        for y, header in enumerate(headers):
+            if str(header).lower() in self.date_fields:
+                date_columns.add(header)
+                continue
 
-    def is_date(self, string, fuzzy=False):
+            values = [row[y] for row in sample if row[y] is not None]
+            if len(values) > 0 and all(self.to_date(value) is not None for value in values):
+                date_columns.add(header)
+
+        return date_columns
+
+    def to_date(self, value):
         """
-        Allows us to programmatically determine if a string is a date
-        :param string: the string to evaluate if a date or not
-        :param fuzzy: determines if the logic should include fuzzy
-        :return: boolean
+        Read a cell value as a date without falling back to fuzzy parsing.
+        :param value: a datetime, date or string starting with an ISO formatted date
+        :return: date, or None if the value is not a date
         """
         self.is_not_used()
-        try:
-            parse(string, fuzzy=fuzzy)
-            return True
-
-        except ValueError:
-            return False
-
-    def message(self, value='', line_before=False):
+        if isinstance(value, datetime):
+            return value.date()
+        if isinstance(value, date):
+            return value
+        if isinstance(value, str) and len(value) >= 10:
+            try:
+                return date.fromisoformat(value[0:10])
+            except ValueError:
+                return None
+
+        return None
+
+    def message(self, value='', line_before=False, group=None):
         """
         Format general messages including attributes.
         :param value: the string to display as a message
         :param line_before: boolean if a blank line should appear before the message
+        :param group: repeats of the same line, or lines sharing a group, are cut short on the console
         :return: None
         """
-        self.is_not_used()
-        if line_before:
-            print('\n')
-        print(Fore.GREEN + '+++ ' + value)
+        if self.log_buffer is not None:
+            self.log_buffer.append(('message', value, line_before, group))
+            return
+        self.log.write('message', value, line_before, group)
 
-    def error(self, value='', line_before=False):
+    def error(self, value='', line_before=False, group=None):
         """
         Format general errors including attributes.
         :param value: the string to display as a message
         :param line_before: boolean if a blank line should appear before the message
+        :param group: repeats of the same line, or lines sharing a group, are cut short on the console
         :return: None
         """
         self.errors += 1
-        if line_before:
-            print('\n')
-        print(Fore.RED + '!!! ' + value)
+        if self.log_buffer is not None:
+            self.log_buffer.append(('error', value, line_before, group))
+            return
+        self.log.write('error', value, line_before, group)
 
-    def warning(self, value='', line_before=False):
+    def warning(self, value='', line_before=False, group=None):
         """
         Format general warnings including attributes.
         :param value: the string to display as a message
         :param line_before: boolean if a blank line should appear before the message
+        :param group: repeats of the same line, or lines sharing a group, are cut short on the console
         :return: None
         """
         self.warnings += 1
-        if line_before:
-            print('\n')
-        print(Fore.YELLOW + '--- ' + value)
+        if self.log_buffer is not None:
+            self.log_buffer.append(('warning', value, line_before, group))
+            return
+        self.log.write('warning', value, line_before, group)
+
+
+def diff_worker(fn_dump, fn_destination, tab, date_fields, manifest=None, engine='python', cache=None):
+    """
+    Worker process entry point for ExcelPY.process_dump_files_parallel. Both files are opened read-only since
+    the worker only produces a changeset, the parent process does all of the writing.
+    :param fn_dump: the dump file to read
+    :param fn_destination: the destination workbook to compare against
+    :param tab: name of the destination tab (sheet) to compare against
+    :param date_fields: column headers that hold dates
+    :param manifest: the part of the incremental manifest for this dump file, None for a full sync
+    :param engine: the diff engine to use
+    :param cache: (directory, max bytes) of the snapshot cache, None to parse both files
+    :return: (list of CellChange or None, list of buffered log records, recorded fingerprints or None,
+              phase timings for the tab, counters for the tab, date column headers, (cache hits, cache misses))
+    """
+    xc = ExcelPY()
+    xc.fn_destination = fn_destination
+    xc.date_fields = date_fields
+    xc.log_buffer = []
+    xc.manifest = manifest
+    xc.arg_engine = engine
+
+    xc.cache = SnapshotCache(*cache) if cache is not None else None
+    wb_dump = load_dump(fn_dump, True, xc.cache)
+    if xc.cache is not None:
+        wb_dest = xc.cache.open_workbook(fn_destination)
+    else:
+        wb_dest = load_workbook(fn_destination, read_only=True)
+    try:
+        changes = xc.diff_dump_file(wb_dump.active, wb_dest[tab], fn_dump)
+    finally:
+        wb_dump.close()
+        wb_dest.close()
+
+    cache_counts = (xc.cache.hits, xc.cache.misses) if xc.cache is not None else (0, 0)
+    return (changes, xc.log_buffer, xc.manifest_updates.get(fn_dump), xc.timings.get(tab, {}), xc.counts.get(tab, {}),
+            xc.date_columns.get(tab, []), cache_counts)
+
+
+def load_worker(fn, cache=None):
+    """
+    Worker process entry point for ExcelPY.open_workbooks. Parses a dump workbook and hands back only its values,
+    which are far cheaper to send between processes than the workbook.
+    :param fn: the workbook to parse
+    :param cache: (directory, max bytes) of the snapshot cache, None to always parse the workbook
+    :return: (list of (title, rows) for each worksheet, the active worksheet first, cache hits, cache misses)
+    """
+    if cache is not None:
+        cache = SnapshotCache(*cache)
+        return cache.read(fn), cache.hits, cache.misses
+
+    return read_workbook_values(fn), 0, 0
 
 
 def clear_screen():
@@ -607,12 +2868,17 @@ def clear_screen():
 
 
 if __name__ == '__main__':
-    clear_screen()
+    if sys.stdout.isatty():  # leave redirected output free of terminal control codes
+        clear_screen()
     init(autoreset=True)
     xc = ExcelPY()
-    xc.start_timer()
-    xc.parse_args()
-    xc.stop_timer()
-    xc.get_execution_time()
+    try:
+        xc.start_timer()
+        xc.parse_args()
+        xc.stop_timer()
+        xc.get_execution_time()
+        xc.write_metrics()
+    finally:
+        xc.log.close()
     del xc
     exit(0)
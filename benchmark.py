@@ -0,0 +1,416 @@
+from datetime import datetime
+from openpyxl import load_workbook, Workbook
+from openpyxl.styles import PatternFill, Font
+from os import close, remove, getcwd, chdir, path
+from platform import python_version
+from shutil import copy2
+from tempfile import mkstemp, TemporaryDirectory
+from ExcelPY import ExcelPY
+
+import argparse
+import json
+import openpyxl
+
+# phases timed by the suite, in pipeline order. Duplicate keys are found while the sheets are read ('dictionary'),
+# only the sqlite engine times them separately and that shows in the JSON breakdown
+PHASES = ['load', 'headers', 'dictionary', 'diff', 'format', 'save']
+
+
+def scale_worksheet(ws, row_count):
+    """
+    Grow a dump worksheet to the requested number of data rows by cycling through its existing rows
+    and giving every copy a unique primary key.
+    :param ws: the worksheet to scale
+    :param row_count: how many data rows the worksheet should end up with
+    :return: None
+    """
+    template = list(ws.iter_rows(2, ws.max_row, values_only=True))
+    ws.delete_rows(2, ws.max_row + 1)
+
+    for x in range(row_count):
+        row = list(template[x % len(template)])
+        row[0] = '{} {}'.format(str(row[0]).split(' ')[0], str(x).zfill(7))
+        ws.append(row)
+
+
+def scan_cell_details(ws, primary_key, header_name):
+    """
+    The original ExcelPY.get_cell_details, a scan down the key column and along the header row for every lookup.
+    :param ws: the worksheet to search
+    :param primary_key: the key field to search
+    :param header_name: the column header to search
+    :return: dictionary in the same layout as ExcelPY.get_cell_details
+    """
+    results = {'cell_found': False, 'key_found': False, 'grid_found': False}
+
+    for x in range(2, ws.max_row + 1):
+        if primary_key == ws.cell(row=x, column=1).value:
+            results['key_found'] = True
+            for y in range(1, ws.max_column + 1):
+                if header_name == ws.cell(row=1, column=y).value:
+                    results['grid_found'] = True
+                    results['row'] = x
+                    results['col'] = y
+                    if ws.cell(row=x, column=y).value is not None:
+                        results['value'] = ws.cell(row=x, column=y).value
+                        results['cell_found'] = True
+                    return results
+
+    return results
+
+
+def parse_cell_by_cell(get_cell_details, ws, headers):
+    """
+    The original parse_worksheet_into_dictionary approach, one cell lookup per row and header.
+    :param get_cell_details: called with (ws, primary key, header) for every lookup
+    :param ws: worksheet to parse
+    :param headers: list of common headers
+    :return: dictionary in the same layout as parse_single_pass
+    """
+    result = {}
+
+    for x in range(2, ws.max_row + 1):
+        data = {}
+        pkey = ws.cell(row=x, column=1).value
+        for key in headers:
+            buffer = get_cell_details(ws, pkey, key)
+            if buffer['cell_found']:
+                data[key] = {'value': buffer['value'], 'row': buffer['row'], 'col': buffer['col']}
+                result[pkey] = data
+
+    return result
+
+
+def parse_single_pass(ws, headers):
+    """
+    Read a worksheet once, top to bottom with iter_rows, keeping the first row of each key like the lookups do.
+    :param ws: worksheet to parse
+    :param headers: list of common headers
+    :return: dictionary of primary key -> {header: {'value', 'row', 'col'}}
+    """
+    columns = {}
+    for x, cell in enumerate(ws[1]):
+        columns.setdefault(cell.value, x + 1)
+    cols = [(d, columns[d]) for d in headers if d in columns]
+    if len(cols) == 0:
+        return {}
+
+    result = {}
+    max_col = max(col for d, col in cols)
+    for x, row in enumerate(ws.iter_rows(2, ws.max_row, 1, max_col, values_only=True)):
+        if row[0] in result:
+            continue
+        data = {d: {'value': row[col - 1], 'row': x + 2, 'col': col} for d, col in cols if row[col - 1] is not None}
+        if len(data) > 0:
+            result[row[0]] = data
+
+    return result
+
+
+def elapsed(func, *args):
+    """
+    Time a single call.
+    :param func: the function to call
+    :param args: arguments passed to func
+    :return: (seconds, return value)
+    """
+    start = datetime.now()
+    value = func(*args)
+    return (datetime.now() - start).total_seconds(), value
+
+
+def benchmark_loader(sizes, scan_limit):
+    """
+    Compare the three ways the sync has loaded a worksheet for each dump file and size: the original lookups that
+    scan the sheet for every cell, the same lookups against the key/header index, and the single pass loader.
+    :param sizes: list of row counts to test
+    :param scan_limit: largest row count the scanning lookups are timed at, they grow with the square of the rows
+    :return: None
+    """
+    xc = ExcelPY()
+    files = [xc.fn_incident, xc.fn_defect, xc.fn_enhancement, xc.fn_alm]
+
+    print('{:<24}{:>10}{:>12}{:>12}{:>12}{:>10}'.format('file', 'rows', 'scan (s)', 'index (s)', 'bulk (s)',
+                                                        'speedup'))
+    for fn in files:
+        wb = load_workbook(fn)
+        ws = wb.active
+        headers = [cell.value for cell in ws[1] if cell.value is not None]
+
+        for size in sizes:
+            scale_worksheet(ws, size)
+            xc.ws_indexes = {}
+            t_index, by_index = elapsed(parse_cell_by_cell, xc.get_cell_details, ws, headers)
+            t_bulk, bulk = elapsed(parse_single_pass, ws, headers)
+            if by_index != bulk:
+                xc.error('[{}] loaders disagree at {} rows'.format(fn.upper(), size))
+
+            if size > scan_limit:
+                print('{:<24}{:>10}{:>12}{:>12.3f}{:>12.3f}{:>10}'.format(fn, size, '-', t_index, t_bulk, '-'))
+                continue
+
+            t_scan, by_scan = elapsed(parse_cell_by_cell, scan_cell_details, ws, headers)
+            if by_scan != bulk:
+                xc.error('[{}] loaders disagree at {} rows'.format(fn.upper(), size))
+            print('{:<24}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}{:>9.1f}x'.format(fn, size, t_scan, t_index, t_bulk,
+                                                                           t_scan / max(t_bulk, 1e-9)))
+        wb.close()
+
+
+def format_cell_uncached(cell, value):
+    """
+    The previous format_cell_updated approach, new style objects for every cell.
+    :param cell: the cell to format
+    :param value: the value to set the cell to
+    :return: None
+    """
+    cell.value = value
+    cell.fill = PatternFill(start_color='7fffd4', end_color='7fffd4', fill_type='solid')
+    cell.font = Font(name='Ubuntu', size=11, color='555555', bold=False, italic=False)
+
+
+def format_and_save(format_func, cell_count):
+    """
+    Format cell_count cells in a new workbook with format_func and save it.
+    :param format_func: called with (cell, value) for every cell
+    :param cell_count: how many cells to format
+    :return: (format seconds, save seconds)
+    """
+    wb = Workbook()
+    ws = wb.active
+    columns = 20
+
+    start = datetime.now()
+    for x in range(cell_count):
+        format_func(ws.cell(row=x // columns + 1, column=x % columns + 1), x)
+    t_format = (datetime.now() - start).total_seconds()
+
+    handle, fn = mkstemp(suffix='.xlsx')
+    close(handle)
+    start = datetime.now()
+    wb.save(fn)
+    t_save = (datetime.now() - start).total_seconds()
+    remove(fn)
+
+    return t_format, t_save
+
+
+def benchmark_formatting(cell_count):
+    """
+    Compare building style objects per cell against the shared style objects used by ExcelPY.
+    :param cell_count: how many cells to format
+    :return: None
+    """
+    xc = ExcelPY()
+
+    print('{:<12}{:>10}{:>14}{:>16}{:>12}'.format('styles', 'cells', 'format (s)', 'per cell (us)', 'save (s)'))
+    for label, func in [('per cell', format_cell_uncached), ('shared', xc.format_cell_updated)]:
+        t_format, t_save = format_and_save(func, cell_count)
+        print('{:<12}{:>10}{:>14.3f}{:>16.2f}{:>12.3f}'.format(label, cell_count, t_format,
+                                                               t_format / cell_count * 1000000, t_save))
+
+
+def run_suite_size(size, seed, overlap):
+    """
+    Generate fixtures of the requested size in the current directory and time a full sync of them.
+    :param size: rows per dump file and destination tab
+    :param seed: seed for the test data generator
+    :param overlap: fraction of dump keys that also exist in the destination
+    :return: dictionary of results for this size
+    """
+    generator = ExcelPY()
+    generator.log_buffer = []  # keep the console quiet, only the results table is printed
+    generator.test_data_row_count = size
+    generator.test_data_seed = seed
+    generator.test_data_overlap = overlap
+    t_generate, _ = elapsed(generator.generate_test_data)
+    del generator
+
+    xc = ExcelPY()
+    xc.log_buffer = []
+    t_sync, _ = elapsed(xc.process_dump_files)
+
+    result = {'rows': size, 'generate': t_generate, 'sync': t_sync, 'cells_updated': xc.cells_updated,
+              'rows_appended': xc.rows_appended, 'errors': xc.errors, 'warnings': xc.warnings,
+              'run': xc.timings.get('run', {}), 'tabs': {}}
+    for tab, timings in xc.timings.items():
+        if tab != 'run':
+            result['tabs'][tab] = timings
+
+    return result
+
+
+def benchmark_suite(sizes, fn_json, seed, overlap):
+    """
+    Time every phase of the sync pipeline at increasing data sizes and write the results as JSON so runs can
+    be compared across releases. Fixtures are generated in a temporary directory from the workbooks in the
+    current directory, which are left untouched.
+    :param sizes: list of row counts to test
+    :param fn_json: file to write the results to
+    :param seed: seed for the test data generator
+    :param overlap: fraction of dump keys that also exist in the destination
+    :return: None
+    """
+    xc = ExcelPY()
+    fixtures = [xc.fn_alm, xc.fn_defect, xc.fn_enhancement, xc.fn_incident, xc.fn_destination]
+    source = getcwd()
+    results = {'date': datetime.now().isoformat(), 'python': python_version(), 'openpyxl': openpyxl.__version__,
+               'seed': seed, 'overlap': overlap, 'runs': []}
+
+    print('{:>8}'.format('rows') + ''.join('{:>12}'.format(phase) for phase in PHASES) + '{:>12}'.format('us/row'))
+    for size in sizes:
+        with TemporaryDirectory() as work:
+            for fn in fixtures:
+                copy2(path.join(source, fn), work)
+            chdir(work)
+            try:
+                result = run_suite_size(size, seed, overlap)
+            finally:
+                chdir(source)
+
+        # total each phase across the tabs so the table stays readable, the JSON keeps the breakdown
+        totals = dict(result['run'])
+        for timings in result['tabs'].values():
+            for phase, seconds in timings.items():
+                totals[phase] = totals.get(phase, 0.0) + seconds
+        result['totals'] = totals
+        result['us_per_row'] = result['sync'] / size * 1000000
+        results['runs'].append(result)
+
+        print('{:>8}'.format(size) + ''.join('{:>12.3f}'.format(totals.get(phase, 0.0)) for phase in PHASES) +
+              '{:>12.1f}'.format(result['us_per_row']))
+
+    # runtime per row should stay flat as the data grows if the pipeline scales linearly
+    first = results['runs'][0]['us_per_row']
+    for run in results['runs']:
+        run['scaling'] = run['us_per_row'] / first
+    print('us/row relative to {} rows: {}'.format(sizes[0], ', '.join('{:.2f}'.format(run['scaling'])
+                                                                       for run in results['runs'])))
+
+    with open(fn_json, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def vary_destination(xc):
+    """
+    Give generated fixtures the cells the generator never makes, where the destination already has a dump value
+    (reset) or has no value yet for an existing key (append). Every 5th shared cell is copied from the dump and
+    every 7th is cleared.
+    :param xc: ExcelPY instance the fixtures were generated with
+    :return: None
+    """
+    wb_dest = load_workbook(xc.fn_destination)
+    for fn_dump, tab in xc.dump_tabs():
+        ws_dump = load_workbook(fn_dump, read_only=True).active
+        rows = ws_dump.iter_rows(values_only=True)
+        dump_header = next(rows)
+        dump = {row[0]: row for row in rows}
+
+        ws = wb_dest[tab]
+        columns = [(y, dump_header.index(cell.value)) for y, cell in enumerate(ws[1]) if y > 0 and
+                   cell.value in dump_header]
+        for x, row in enumerate(ws.iter_rows(min_row=2)):
+            values = dump.get(row[0].value)
+            if values is None:
+                continue
+            for y, dump_col in columns:
+                if (x + y) % 7 == 0:
+                    row[y].value = None
+                elif (x + y) % 5 == 0:
+                    row[y].value = values[dump_col]
+    wb_dest.save(xc.fn_destination)
+
+
+def check_engines(size, seed, overlap):
+    """
+    Diff generated fixtures with every --engine and check that they produce identical changesets, cell for cell
+    and in the same order. The fixtures are generated in a temporary directory from the workbooks in the current
+    directory and have updated, unchanged, appended and new cells.
+    :param size: rows per dump file and destination tab
+    :param seed: seed for the test data generator
+    :param overlap: fraction of dump keys that also exist in the destination
+    :return: boolean, True if every engine agreed on every tab
+    """
+    xc = ExcelPY()
+    fixtures = [xc.fn_alm, xc.fn_defect, xc.fn_enhancement, xc.fn_incident, xc.fn_destination]
+    tabs = xc.dump_tabs()
+    source = getcwd()
+    engines = ['python', 'numpy', 'sqlite']
+    results = {}
+
+    with TemporaryDirectory() as work:
+        for fn in fixtures:
+            copy2(path.join(source, fn), work)
+        chdir(work)
+        try:
+            generator = ExcelPY()
+            generator.log_buffer = []
+            generator.test_data_row_count = size
+            generator.test_data_seed = seed
+            generator.test_data_overlap = overlap
+            generator.generate_test_data()
+            vary_destination(generator)
+            del generator
+
+            for engine in engines:
+                xc = ExcelPY()
+                xc.log_buffer = []
+                xc.arg_engine = engine
+                xc.open_workbooks(True)
+                workbooks = {xc.fn_incident: xc.wb_incident,
+                             xc.fn_defect: xc.wb_defect,
+                             xc.fn_enhancement: xc.wb_enhancement,
+                             xc.fn_alm: xc.wb_alm}
+                for fn_dump, tab in tabs:
+                    results[engine, tab] = xc.diff_dump_file(workbooks[fn_dump].active, xc.wb_destination[tab],
+                                                             fn_dump)
+                del xc
+        finally:
+            chdir(source)
+
+    agreed = True
+    print('{:<26}{:>8}{:>10}{:>10}{:>10}{:>10}   {}'.format('tab', 'engine', 'update', 'reset', 'append', 'new',
+                                                           'changeset'))
+    for fn_dump, tab in tabs:
+        expected = results['python', tab]
+        for engine in engines:
+            changes = results[engine, tab]
+            same = changes == expected
+            agreed = agreed and same
+            kinds = [sum(1 for change in changes or [] if change.kind == kind)
+                     for kind in ('update', 'reset', 'append', 'new')]
+            print('{:<26}{:>8}{:>10}{:>10}{:>10}{:>10}   {}'.format(tab, engine, *kinds,
+                                                                   'identical' if same else 'DIFFERENT'))
+
+    return agreed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes', dest='sizes', help='Row counts to benchmark.',
+                        type=int, nargs='+', default=None)
+    parser.add_argument('--scan-limit', dest='scan_limit',
+                        help='Largest row count the original scanning loader is timed at.', type=int, default=1000)
+    parser.add_argument('-f', '--format', dest='format', help='Benchmark cell formatting on this many cells.',
+                        type=int, default=0)
+    parser.add_argument('--suite', action='store_true', dest='suite',
+                        help='Time each phase of a full sync on generated fixtures.', default=False)
+    parser.add_argument('--json', dest='json', help='File the suite results are written to.',
+                        default='benchmark-results.json')
+    parser.add_argument('--seed', dest='seed', help='Seed used when generating fixtures.', type=int, default=1)
+    parser.add_argument('--engines', action='store_true', dest='engines',
+                        help='Check that every diff engine produces the same changeset on generated fixtures.',
+                        default=False)
+    parser.add_argument('--overlap', dest='overlap', help='Fraction of dump keys that exist in the destination.',
+                        type=float, default=0.9)
+    args = parser.parse_args()
+
+    if args.format > 0:
+        benchmark_formatting(args.format)
+    elif args.engines:
+        if not check_engines((args.sizes or [2000])[0], args.seed, args.overlap):
+            raise SystemExit(1)
+    elif args.suite:
+        benchmark_suite(args.sizes or [1000, 10000, 50000, 200000], args.json, args.seed, args.overlap)
+    else:
+        benchmark_loader(args.sizes or [1000, 10000, 50000], args.scan_limit)